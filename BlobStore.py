@@ -0,0 +1,47 @@
+import hashlib
+import zlib
+from functools import lru_cache
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Content-addressed, compressed storage for MODS and DC XML shared by many rows.
+class BlobStore:
+    def __init__(self, conn):
+        self.conn = conn
+        self.codec = 'zstd' if zstandard else 'zlib'
+        self.get = lru_cache(maxsize=4096)(self.read)
+
+    def compress(self, data):
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=10).compress(data)
+        return zlib.compress(data, 9)
+
+    def decompress(self, codec, data):
+        if codec == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
+
+    # Stores text once and returns the hash rows should reference. Only new content is compressed.
+    def put(self, text):
+        data = text.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        if self.conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (digest,)).fetchone() is None:
+            self.conn.execute("INSERT OR IGNORE INTO blobs VALUES(?, ?, ?, ?)",
+                              (digest, self.codec, len(data), self.compress(data)))
+        return digest
+
+    def read(self, digest):
+        row = self.conn.execute("SELECT codec, data FROM blobs WHERE hash = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        return self.decompress(row[0], row[1]).decode('utf-8')
+
+    # Returns the inline value of a column, or the blob it references.
+    def resolve(self, text, digest):
+        if digest:
+            return self.get(digest)
+        return text
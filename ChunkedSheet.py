@@ -0,0 +1,123 @@
+import csv
+import os
+import shutil
+from pathlib import Path
+
+
+# Workbench sheet split into numbered chunks of at most max_rows rows or max_bytes of files, each with its
+# own file subdirectory, so several workbench processes can ingest in parallel. The file column is relative
+# to filepath, so one input_dir serves every chunk. Without limits it writes one sheet and a flat directory.
+# A chunk's sheet is only created when its first row is written, so chunks whose copies all failed leave
+# no header-only sheets behind.
+class ChunkedSheet:
+    # With append=True and a key column, self.existing holds the keys of rows already in earlier sheets.
+    def __init__(self, sheetpath, filepath, name, headers, max_rows=None, max_bytes=None, append=False, key=None):
+        self.sheetpath = sheetpath
+        self.filepath = filepath
+        self.name = name
+        self.headers = headers
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.append = append
+        self.chunked = bool(max_rows or max_bytes)
+        self.chunk = -1
+        # Chunks started by this run.
+        self.started = []
+        self.rows = 0
+        self.bytes = 0
+        # Open (file, writer) per chunk; rows can complete after a later chunk has been started.
+        self.open_sheets = {}
+        self.sheets = []
+        self.existing = set()
+        if append and key:
+            sheets = [*Path(sheetpath).glob(f"{name}.csv"), *Path(sheetpath).glob(f"{name}_[0-9][0-9][0-9][0-9].csv")]
+            for sheet in sheets:
+                with open(sheet, newline='') as f:
+                    self.existing.update(row[key] for row in csv.DictReader(f))
+        Path(sheetpath).mkdir(parents=True, exist_ok=True)
+        Path(filepath).mkdir(parents=True, exist_ok=True)
+        chunks = sorted(Path(sheetpath).glob(f"{name}_[0-9][0-9][0-9][0-9].csv"))
+        if not self.chunked:
+            self.next_chunk()
+            self.open(self.chunk)
+        elif append:
+            # Resumed runs start new chunks after the ones already written; skipped empty chunks leave gaps.
+            self.chunk = max((int(sheet.stem[-4:]) for sheet in chunks), default=-1)
+        else:
+            # A fresh run replaces every chunk of an earlier one, so no stale sheets get ingested with it.
+            for sheet in chunks:
+                sheet.unlink()
+            for directory in Path(filepath).glob(f"{name}_[0-9][0-9][0-9][0-9]"):
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def chunk_name(self):
+        return f"{self.name}_{self.chunk:04d}"
+
+    def next_chunk(self):
+        self.chunk += 1
+        self.started.append(self.chunk)
+        self.rows = 0
+        self.bytes = 0
+        if self.chunked:
+            Path(f"{self.filepath}/{self.chunk_name()}").mkdir(parents=True, exist_ok=True)
+
+    # Opens the sheet of a chunk and writes its header, unless it is appended to.
+    def open(self, chunk):
+        if self.chunked:
+            sheet = Path(f"{self.sheetpath}/{self.name}_{chunk:04d}.csv")
+            append = False
+        else:
+            sheet = Path(f"{self.sheetpath}/{self.name}.csv")
+            append = self.append and sheet.exists()
+        csvfile = open(sheet, 'a' if append else 'w', newline='')
+        writer = csv.DictWriter(csvfile, fieldnames=self.headers)
+        if not append:
+            writer.writeheader()
+        self.open_sheets[chunk] = (csvfile, writer)
+        self.sheets = sorted([*self.sheets, str(sheet)])
+        return writer
+
+    # Reserves room for one file of size bytes in the current chunk (self.chunk);
+    # returns where to write it and the value for the file column.
+    def place(self, filename, size=0):
+        full = self.max_rows and self.rows >= self.max_rows
+        full = full or (self.max_bytes and self.rows and self.bytes + size > self.max_bytes)
+        if not self.started or full:
+            self.next_chunk()
+        self.rows += 1
+        self.bytes += size
+        if not self.chunked:
+            return f"{self.filepath}/{filename}", filename
+        relative = f"{self.chunk_name()}/{filename}"
+        return f"{self.filepath}/{relative}", relative
+
+    # Writes a row to the chunk its file was placed in, the current chunk by default.
+    def writerow(self, row, chunk=None):
+        chunk = self.chunk if chunk is None else chunk
+        writer = self.open_sheets[chunk][1] if chunk in self.open_sheets else self.open(chunk)
+        writer.writerow(row)
+
+    # Makes every row written so far durable, before the journal records those objects as done.
+    def sync(self):
+        for csvfile, writer in self.open_sheets.values():
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
+
+    def close(self):
+        for csvfile, writer in self.open_sheets.values():
+            csvfile.close()
+        self.open_sheets = {}
+        if self.chunked:
+            # File subdirectories of chunks that never got a row; kept if anything was staged into them.
+            for chunk in self.started:
+                if not Path(f"{self.sheetpath}/{self.name}_{chunk:04d}.csv").exists():
+                    try:
+                        os.rmdir(f"{self.filepath}/{self.name}_{chunk:04d}")
+                    except OSError:
+                        pass
@@ -4,9 +4,7 @@ import lxml.etree as ET
 
 
 class FWorker:
-    def __init__(self, foxml_file):
-        self.tree = ET.parse(foxml_file)
-        self.root = self.tree.getroot()
+    def __init__(self, foxml_file, streaming=False):
         self.namespaces = {
             'foxml': 'info:fedora/fedora-system:def/foxml#',
             'oai_dc': 'http://www.openarchives.org/OAI/2.0/oai_dc/',
@@ -17,8 +15,24 @@ class FWorker:
             'islandora': "http://islandora.ca/ontology/relsext#",
             'mods': 'http://www.loc.gov/mods/v3'
         }
+        if streaming:
+            self.root = self.iterparse_latest(foxml_file)
+            self.tree = self.root.getroottree()
+        else:
+            self.tree = ET.parse(foxml_file)
+            self.root = self.tree.getroot()
         self.mods_xsl = 'assets/mods_to_dc.xsl'
         self.properties = self.get_properties()
+        self.datastreams = self.index_datastreams()
+
+    # Parses foxml incrementally, dropping all but the latest version of each datastream.
+    def iterparse_latest(self, foxml_file):
+        version_tag = f"{{{self.namespaces['foxml']}}}datastreamVersion"
+        context = ET.iterparse(foxml_file, events=('end',), tag=version_tag)
+        for event, version in context:
+            for previous in list(version.itersiblings(version_tag, preceding=True)):
+                version.getparent().remove(previous)
+        return context.root
 
     # Returns PID from foxml
     def get_pid(self):
@@ -37,41 +51,45 @@ class FWorker:
             values[name] = value
         return values
 
+    # Walks the datastreams once, keeping the latest version of each.
+    def index_datastreams(self):
+        index = {}
+        for datastream in self.root.iterfind('foxml:datastream', self.namespaces):
+            entry = {'mimetype': None, 'location': None, 'content': None}
+            for version in datastream.iterfind('foxml:datastreamVersion', self.namespaces):
+                entry['mimetype'] = version.attrib['MIMETYPE']
+                location = version.find('foxml:contentLocation', self.namespaces)
+                if location is not None:
+                    entry['location'] = location.attrib['REF']
+                content = version.find('foxml:xmlContent', self.namespaces)
+                if content is not None:
+                    entry['content'] = content
+            index[datastream.attrib['ID']] = entry
+        return index
+
+    # Returns xmlContent node of latest version of a datastream.
+    def get_xml_content(self, stream):
+        return self.datastreams.get(stream, {}).get('content')
+
     # Gets all datastream types from foxml.
     def get_datastreams(self):
-        ns = {'': 'info:fedora/fedora-system:def/foxml#'}
-        datastreams = self.root.findall('.//foxml:datastream', self.namespaces)
-        types = {}
-        for datastream in datastreams:
-            versions = datastream.findall('./foxml:datastreamVersion', self.namespaces)
-            mimetype = versions[-1].attrib['MIMETYPE']
-            types[datastream.attrib['ID']] = mimetype
-        return types
+        return {stream: entry['mimetype'] for stream, entry in self.datastreams.items()}
 
     # Gets names of current managed files from foxml.
     def get_file_data(self):
         mapping = {}
-        streams = self.get_datastreams()
-        for stream, mimetype in streams.items():
-            location = self.root.xpath(
-                f'//foxml:datastream[@ID="{stream}"]/foxml:datastreamVersion/foxml:contentLocation',
-                namespaces=self.namespaces)
-            if location:
-                mapping[stream] = {'filename': location[-1].attrib['REF'], 'mimetype': mimetype}
+        for stream, entry in self.datastreams.items():
+            if entry['location']:
+                mapping[stream] = {'filename': entry['location'], 'mimetype': entry['mimetype']}
         return mapping
 
     def get_dc(self):
-        dc_nodes = self.root.findall(
-            f'.//foxml:datastream[@ID="DC"]/foxml:datastreamVersion/foxml:xmlContent/oai_dc:dc',
-            namespaces=self.namespaces)
-        dc_node = dc_nodes[-1]
+        dc_node = self.get_xml_content('DC').find('oai_dc:dc', self.namespaces)
         return ET.tostring(dc_node, encoding='unicode')
 
     def get_dc_values(self):
-        dc_nodes = self.root.findall(f'.//foxml:datastream[@ID="DC"]/foxml:datastreamVersion/foxml:xmlContent',
-                                     namespaces=self.namespaces)
         dc_values = []
-        dc_node = dc_nodes[-1]
+        dc_node = self.get_xml_content('DC')
         for child in dc_node.iter():
             if child.text is not None:
                 cleaned = child.text.replace('\n', '')
@@ -83,9 +101,7 @@ class FWorker:
 
     # Converts embedded dublin core to dspace dublin core
     def get_modified_dc(self):
-        dc_nodes = self.root.findall(f'.//foxml:datastream[@ID="DC"]/foxml:datastreamVersion/foxml:xmlContent',
-                                     namespaces=self.namespaces)
-        dc_node = dc_nodes[-1]
+        dc_node = self.get_xml_content('DC')
         return self.build_dspace_dc(dc_node)
 
     # Builds dspace xml from extracted values/
@@ -116,10 +132,7 @@ class FWorker:
 
     def get_rels_ext_values(self):
         re_values = {}
-        re_nodes = self.root.findall(
-            f'.//foxml:datastream[@ID="RELS-EXT"]/foxml:datastreamVersion/foxml:xmlContent/rdf:RDF',
-            namespaces=self.namespaces)
-        re_node = re_nodes[-1]
+        re_node = self.get_xml_content('RELS-EXT').find('rdf:RDF', self.namespaces)
         for child in re_node.iter():
             tag = child.xpath('local-name()')
             if child.text is not None:
@@ -138,12 +151,10 @@ class FWorker:
 
     def get_rels_int_values(self):
         ri_values = {}
-        ri_nodes = self.root.findall(
-            f'.//foxml:datastream[@ID="RELS-INT"]/foxml:datastreamVersion/foxml:xmlContent/rdf:RDF',
-            namespaces=self.namespaces)
-        if not ri_nodes:
+        ri_content = self.get_xml_content('RELS-INT')
+        if ri_content is None:
             return ri_values
-        ri_node = ri_nodes[-1]
+        ri_node = ri_content.find('rdf:RDF', self.namespaces)
         for child in ri_node.iter():
             tag = child.xpath('local-name()')
             if tag not in ri_values:
@@ -166,13 +177,10 @@ class FWorker:
     def get_inline_mods(self):
         retval = ''
         try:
-            mods_datastream = self.root.findall(
-                ".//foxml:datastream[@ID='MODS']/foxml:datastreamVersion/foxml:xmlContent/mods:mods",
-                self.namespaces
-            )
-            if not mods_datastream:
+            mods_content = self.get_xml_content('MODS')
+            if mods_content is None:
                 return retval
-            mods_node = mods_datastream[-1]
+            mods_node = mods_content.find('mods:mods', self.namespaces)
             if mods_node is not None:
                 retval = ET.tostring(mods_node, encoding='unicode')
 
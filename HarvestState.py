@@ -0,0 +1,59 @@
+import os
+
+
+# FOXML mtime and size seen by the last run of a harvest, used to reprocess only changed objects.
+class HarvestState:
+    def __init__(self, conn, operation):
+        self.conn = conn
+        self.operation = operation
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            CREATE TABLE if not exists harvest_state(
+            operation TEXT,
+            pid TEXT,
+            mtime REAL,
+            size INTEGER,
+            PRIMARY KEY (operation, pid)
+            )""")
+        self.conn.commit()
+        cursor.execute("SELECT pid, mtime, size FROM harvest_state WHERE operation = ?", (operation,))
+        self.previous = {row[0]: (row[1], row[2]) for row in cursor}
+        self.current = {}
+
+    # Returns True if the object is new or its FOXML has changed since the last run.
+    def changed(self, pid, foxml):
+        try:
+            stat = os.stat(foxml)
+        except OSError:
+            return True
+        self.current[pid] = (stat.st_mtime, stat.st_size)
+        return self.previous.get(pid) != self.current[pid]
+
+    # Stores the signature of an object once it has been processed.
+    def save(self, pid):
+        if pid in self.current:
+            cursor = self.conn.cursor()
+            cursor.execute("INSERT OR REPLACE INTO harvest_state VALUES(?, ?, ?, ?)",
+                           (self.operation, pid, *self.current[pid]))
+
+    def save_many(self, pids):
+        cursor = self.conn.cursor()
+        cursor.executemany("INSERT OR REPLACE INTO harvest_state VALUES(?, ?, ?, ?)",
+                           ((self.operation, pid, *self.current[pid]) for pid in pids if pid in self.current))
+
+    # Returns PIDS harvested last time that are no longer in the objectStore, and forgets them.
+    def deleted(self):
+        gone = sorted(set(self.previous) - set(self.current))
+        cursor = self.conn.cursor()
+        cursor.executemany("DELETE FROM harvest_state WHERE operation = ? AND pid = ?",
+                           [(self.operation, pid) for pid in gone])
+        self.conn.commit()
+        return gone
+
+    def write_deleted(self, output_file):
+        gone = self.deleted()
+        with open(output_file, 'w') as f:
+            for pid in gone:
+                f.write(f"{pid}\n")
+        print(f"{len(gone)} deleted PIDS written to {output_file}")
+        return gone
@@ -0,0 +1,53 @@
+import hashlib
+from datetime import datetime, timezone
+
+
+# Per-object record of completed work, so interrupted runs can resume where they stopped.
+class Journal:
+    def __init__(self, conn, commit_every=500):
+        self.conn = conn
+        self.commit_every = commit_every
+        self.pending = 0
+        # Called before each commit, e.g. to flush output that must not lag behind the journal.
+        self.before_commit = []
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            CREATE TABLE if not exists journal(
+            operation TEXT,
+            pid TEXT,
+            status TEXT,
+            checksum TEXT,
+            timestamp TEXT,
+            PRIMARY KEY (operation, pid)
+            )""")
+        self.conn.commit()
+
+    # Returns PIDS already completed for an operation.
+    def completed(self, operation):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT pid FROM journal WHERE operation = ? AND status = 'done'", (operation,))
+        return {row[0] for row in cursor}
+
+    def record(self, operation, pid, status, checksum=''):
+        cursor = self.conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO journal VALUES(?, ?, ?, ?, ?)",
+                       (operation, pid, status, checksum, datetime.now(timezone.utc).isoformat()))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def record_many(self, operation, entries):
+        timestamp = datetime.now(timezone.utc).isoformat()
+        cursor = self.conn.cursor()
+        cursor.executemany("INSERT OR REPLACE INTO journal VALUES(?, ?, ?, ?, ?)",
+                           ((operation, pid, status, checksum, timestamp) for pid, status, checksum in entries))
+
+    def commit(self):
+        for hook in self.before_commit:
+            hook()
+        self.conn.commit()
+        self.pending = 0
+
+
+def checksum(*parts):
+    return hashlib.md5('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
@@ -15,11 +15,12 @@ def make_media_delete_sheet(filename):
 def change_file_name(filename):
     su = ScholarUtilities.ScholarUtilities()
     with open(filename, 'r') as file:
-        with open('outputs/name_change.sh', 'w') as outfile:
-            for line in file:
-                parts = line.split('_')
-                nid = su.get_nid_from_pid('imagined', parts[0])
-                outfile.write(f"mv {line.strip()} {nid}_OBJ.ppm\n")
+        lines = file.readlines()
+    nids = su.get_nids_for_pids('imagined', [line.split('_')[0] for line in lines])
+    with open('outputs/name_change.sh', 'w') as outfile:
+        for line in lines:
+            nid = nids.get(line.split('_')[0])
+            outfile.write(f"mv {line.strip()} {nid}_OBJ.ppm\n")
 
 def make_ppm_ingest():
     with open('outputs/name_change.sh') as input:
@@ -33,12 +34,13 @@ def make_ppm_ingest():
 def build_signature_sheet():
     su = ScholarUtilities.ScholarUtilities()
     with open('inputs/signature_filelist.txt') as input:
-        with open('outputs/add_signature_media', 'w') as outfile:
-            outfile.write('node_id,file\n')
-            for line in input:
-                pid = line.split('_sig')[0].replace('_', ':')
-                nid = su.get_nid_from_pid('islandscholar', pid)
-                outfile.write(f"{nid},{line}")
+        lines = input.readlines()
+    nids = su.get_nids_for_pids('islandscholar', [line.split('_sig')[0].replace('_', ':') for line in lines])
+    with open('outputs/add_signature_media', 'w') as outfile:
+        outfile.write('node_id,file\n')
+        for line in lines:
+            nid = nids.get(line.split('_sig')[0].replace('_', ':'))
+            outfile.write(f"{nid},{line}")
 
 build_signature_sheet()
 
@@ -0,0 +1,153 @@
+from collections import defaultdict
+
+CONTAINER_PREDICATES = ('isMemberOfCollection', 'isMemberOf', 'isPageOf', 'isConstituentOf')
+
+
+# Turns FWorker.get_rels_ext_values output into (subject, predicate, object) edges, one per pipe-joined value.
+def edges(pid, rels_ext_values):
+    for predicate, value in rels_ext_values.items():
+        for obj in value.split('|'):
+            obj = obj.strip()
+            if obj:
+                yield pid, predicate, obj
+
+
+# Normalized RELS-EXT relationships, queried recursively instead of scanning the denormalized object tables.
+class RelsGraph:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def add(self, pid, rels_ext_values):
+        self.add_many(edges(pid, rels_ext_values))
+
+    def add_many(self, rows):
+        self.conn.executemany("INSERT OR IGNORE INTO rels_ext VALUES(?, ?, ?)", rows)
+
+    # Replaces the edges of one object, for reloads of changed FOXML.
+    def replace(self, pid, rels_ext_values):
+        self.conn.execute("DELETE FROM rels_ext WHERE subject = ?", (pid,))
+        self.add(pid, rels_ext_values)
+
+    # Rebuilds the edges of an object table's rows from its denormalized columns (ScholarSchema.RELS_COLUMNS).
+    def load_table(self, table, rels_columns):
+        columns = list(rels_columns)
+        cursor = self.conn.cursor()
+        cursor.execute(f"DELETE FROM rels_ext WHERE subject IN (SELECT pid FROM {table})")
+        rows = (edge for row in cursor.execute(f"SELECT pid, {', '.join(columns)} FROM {table}")
+                for edge in edges(row[0], {rels_columns[column]: row[i + 1] or ''
+                                           for i, column in enumerate(columns)}))
+        self.add_many(rows)
+        self.conn.commit()
+
+    def children(self, pid, predicates=CONTAINER_PREDICATES):
+        placeholders = ', '.join('?' * len(predicates))
+        statement = f"SELECT subject FROM rels_ext WHERE object = ? AND predicate IN ({placeholders})"
+        return [row[0] for row in self.conn.execute(statement, (pid, *predicates))]
+
+    # Every object below pid as (pid, parent, depth), breadth first. max_depth guards against cycles.
+    def descendants(self, pid, predicates=CONTAINER_PREDICATES, max_depth=32):
+        placeholders = ', '.join('?' * len(predicates))
+        statement = f"""
+            WITH RECURSIVE tree(pid, parent, depth) AS (
+                SELECT subject, object, 1 FROM rels_ext WHERE object = ? AND predicate IN ({placeholders})
+                UNION
+                SELECT r.subject, r.object, tree.depth + 1 FROM rels_ext r JOIN tree ON r.object = tree.pid
+                WHERE r.predicate IN ({placeholders}) AND tree.depth < ?
+            )
+            SELECT pid, parent, MIN(depth) FROM tree GROUP BY pid, parent ORDER BY MIN(depth), pid"""
+        return self.conn.execute(statement, (pid, *predicates, *predicates, max_depth)).fetchall()
+
+    # Every object above pid as (pid, child, depth), nearest first.
+    def ancestors(self, pid, predicates=CONTAINER_PREDICATES, max_depth=32):
+        placeholders = ', '.join('?' * len(predicates))
+        statement = f"""
+            WITH RECURSIVE tree(pid, child, depth) AS (
+                SELECT object, subject, 1 FROM rels_ext WHERE subject = ? AND predicate IN ({placeholders})
+                UNION
+                SELECT r.object, r.subject, tree.depth + 1 FROM rels_ext r JOIN tree ON r.subject = tree.pid
+                WHERE r.predicate IN ({placeholders}) AND tree.depth < ?
+            )
+            SELECT pid, child, MIN(depth) FROM tree GROUP BY pid, child ORDER BY MIN(depth), pid"""
+        return self.conn.execute(statement, (pid, *predicates, *predicates, max_depth)).fetchall()
+
+    # Every object below pid with one of the given content models, once each, as (pid, parents, content_model).
+    # parents pipe-joins all of the object's parents, as the denormalized collection_pid column does.
+    def members(self, pid, models, predicates=CONTAINER_PREDICATES, max_depth=32):
+        placeholders = ', '.join('?' * len(predicates))
+        model_placeholders = ', '.join('?' * len(models))
+        statement = f"""
+            WITH RECURSIVE tree(pid, depth) AS (
+                SELECT subject, 1 FROM rels_ext WHERE object = ? AND predicate IN ({placeholders})
+                UNION
+                SELECT r.subject, tree.depth + 1 FROM rels_ext r JOIN tree ON r.object = tree.pid
+                WHERE r.predicate IN ({placeholders}) AND tree.depth < ?
+            )
+            SELECT t.pid,
+                   (SELECT group_concat(object, '|') FROM
+                       (SELECT object FROM rels_ext WHERE subject = t.pid AND predicate IN ({placeholders})
+                        ORDER BY object)),
+                   m.object
+            FROM (SELECT pid, MIN(depth) AS depth FROM tree GROUP BY pid) t
+            JOIN rels_ext m ON m.subject = t.pid AND m.predicate = 'hasModel'
+            WHERE m.object IN ({model_placeholders})
+            ORDER BY t.depth, t.pid"""
+        params = (pid, *predicates, *predicates, max_depth, *predicates, *models)
+        return self.conn.execute(statement, params).fetchall()
+
+    def parents(self, pid, predicates=CONTAINER_PREDICATES):
+        placeholders = ', '.join('?' * len(predicates))
+        statement = f"SELECT object FROM rels_ext WHERE subject = ? AND predicate IN ({placeholders}) ORDER BY object"
+        return [row[0] for row in self.conn.execute(statement, (pid, *predicates))]
+
+    # Ingest level of each pid: 0 when none of its parents are in pids, otherwise one more than its deepest
+    # parent, so every parent lands in an earlier level than its children. Objects in or below a cycle
+    # are reported and put in a final level of their own.
+    def levels(self, pids, predicates=CONTAINER_PREDICATES):
+        pids = set(pids)
+        placeholders = ', '.join('?' * len(predicates))
+        statement = f"SELECT subject, object FROM rels_ext WHERE predicate IN ({placeholders})"
+        children = defaultdict(set)
+        waiting = dict.fromkeys(pids, 0)
+        for subject, obj in self.conn.execute(statement, predicates):
+            if subject in pids and obj in pids and subject != obj and subject not in children[obj]:
+                children[obj].add(subject)
+                waiting[subject] += 1
+        levels = {}
+        level = 0
+        frontier = [pid for pid, count in waiting.items() if count == 0]
+        while frontier:
+            following = []
+            for pid in frontier:
+                levels[pid] = level
+                for child in children[pid]:
+                    waiting[child] -= 1
+                    if waiting[child] == 0:
+                        following.append(child)
+            frontier = following
+            level += 1
+        cycled = pids - set(levels)
+        if cycled:
+            print(f"{len(cycled)} objects in or below RELS-EXT cycles, placed in level {level}: {sorted(cycled)[:10]}")
+            levels.update(dict.fromkeys(cycled, level))
+        return levels
+
+    def content_model(self, pid):
+        row = self.conn.execute("SELECT object FROM rels_ext WHERE subject = ? AND predicate = 'hasModel'",
+                                (pid,)).fetchone()
+        return row[0] if row else None
+
+    # Pages as (pid, book, sequence), ordered by book and numeric sequence; one book, or all books in a namespace.
+    def pages(self, book=None, namespace=''):
+        statement = """
+            SELECT p.subject, p.object, s.object FROM rels_ext p
+            LEFT JOIN rels_ext s ON s.subject = p.subject AND s.predicate = 'isSequenceNumber'
+            WHERE p.predicate = 'isPageOf'"""
+        params = ()
+        if book:
+            statement += " AND p.object = ?"
+            params = (book,)
+        elif namespace:
+            statement += " AND p.object >= ? AND p.object < ?"
+            params = (f"{namespace}:", f"{namespace};")
+        statement += " ORDER BY p.object, CAST(s.object AS INTEGER), p.subject"
+        return self.conn.execute(statement, params).fetchall()
@@ -2,7 +2,6 @@
 
 import csv
 import re
-import shutil
 import time
 from os import write
 from pathlib import Path
@@ -10,6 +9,11 @@ import sqlite3
 import lxml.etree as ET
 import FoxmlWorker as FW
 import ScholarUtilities as SU
+from StagingEngine import StagingEngine
+from ChunkedSheet import ChunkedSheet
+import Journal
+import ScholarSchema
+import RelsGraph
 
 
 class ScholarProcessor:
@@ -20,6 +24,8 @@ class ScholarProcessor:
         self.conn = sqlite3.connect('scholar.db')
         self.conn.row_factory = sqlite3.Row
         self.su = SU.ScholarUtilities()
+        self.journal = Journal.Journal(self.conn)
+        self.graph = RelsGraph.RelsGraph(self.conn)
         self.scholar = 'https://scholar.researchspaces.ca'
         self.content_model_primary_map = {
             'ir:citationCModel': '',
@@ -39,7 +45,7 @@ class ScholarProcessor:
                         }
 
     # Takes csv generated on productions server and updates the database with each object with its hierarchy.
-    def populate_database(self, csv_file):
+    def populate_database(self, csv_file, batch_size=10000):
         cursor = self.conn.cursor()
         cursor.execute(f"""
             CREATE TABLE if not exists islandscholar(
@@ -52,25 +58,15 @@ class ScholarProcessor:
             constituent_of TEXT
             )""")
         self.conn.commit()
+        ScholarSchema.ensure_object_table(self.conn, 'islandscholar')
         with open(csv_file, newline='') as csvfile:
             reader = csv.DictReader(csvfile)
-            for row in reader:
-                collection = row['collection_pid']
-                nid = row['nid']
-                if not nid:
-                    nid = ''
-                page_of = row['page_of']
-                if not page_of:
-                    page_of = ' '
-                constituent_of = row['constituent_of']
-                if not constituent_of:
-                    constituent_of = ' '
-                try:
-                    command = f"INSERT OR REPLACE INTO islandscholar VALUES('{row['pid']}', '{nid}' '{row['content_model']}', '{collection}','{page_of}', '{row['sequence']}','{constituent_of}')"
-                    cursor.execute(command)
-                except sqlite3.Error:
-                    print(row['PID'])
-        self.conn.commit()
+            rows = ((row['pid'], row['nid'] or '', row['content_model'], row['collection_pid'],
+                     row['page_of'] or ' ', row['sequence'], row['constituent_of'] or ' ') for row in reader)
+            SU.bulk_load(self.conn, """INSERT OR REPLACE INTO islandscholar
+                (pid, nid, content_model, collection_pid, page_of, sequence, constituent_of)
+                VALUES(?, ?, ?, ?, ?, ?, ?)""", rows, batch_size)
+        self.graph.load_table('islandscholar', ScholarSchema.RELS_COLUMNS)
 
     # Updates the database to include nids from the new system mapped to exising pids.
     def update_pid_nid_mapping(self, csv_file):
@@ -81,6 +77,7 @@ class ScholarProcessor:
                 statement = f"update islandscholar set nid = '{row['node_id']}' where pid = '{row['field_pid']}'"
                 cursor.execute(statement)
         self.conn.commit()
+        self.su.nid_maps.pop('islandscholar', None)
 
     # Builds workbench sheet to ingest primary assets from current site using RESTFULL interface
     def build_workbench_sheet(self, collection_pid):
@@ -104,8 +101,12 @@ class ScholarProcessor:
                 writer.writerow({'node_id': row['nid'], 'file': filename})
 
     # Builds workbench sheet to ingest primary assets harvesting from the Fedora data dir.
-    def build_workbench_sheet_remote(self):
-        output_file_name = f"imagined_add_media_workbench.csv"
+    # With resume=True, objects already staged are skipped and their rows kept from the previous run.
+    # With max_rows or max_bytes the sheet is split into chunks with matching file subdirectories.
+    def build_workbench_sheet_remote(self, resume=False, max_rows=None, max_bytes=None):
+        output_file_name = f"imagined_add_media_workbench"
+        operation = 'build_workbench_sheet_remote'
+        done = self.journal.completed(operation) if resume else set()
         cursor = self.conn.cursor()
         statement = f"""
                 SELECT nid, pid, content_model
@@ -115,58 +116,80 @@ class ScholarProcessor:
         headers = ['node_id', 'file']
         filepath = 'workbench_files'
         sheetpath = 'workbench_sheets'
-        # Build directory
-        Path(filepath).mkdir(parents=True, exist_ok=True)
-        Path(sheetpath).mkdir(parents=True, exist_ok=True)
-        with open(f"{sheetpath}/{output_file_name}", 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=headers)
-            writer.writeheader()
-            for row in cursor.execute(statement):
-                foxml_file = self.su.dereference(row['pid'])
-                foxml = f"{self.objectStore}/{foxml_file}"
-                fw = FW.FWorker(foxml)
-                if fw.properties['state'] != 'Active':
-                    continue
-                all_datastreams = fw.get_file_data()
-                original_file = False
-                if 'PDF' in all_datastreams:
-                    original_file = 'PDF'
-                if 'OBJ' in all_datastreams:
-                    original_file = 'OBJ'
-                if original_file in all_datastreams:
-                    datastream_data = all_datastreams[original_file]
-                    source = f"{self.datastreamStore}/{self.su.dereference(datastream_data['filename'])}"
-                    mime_ext = '.bin'
-                    if datastream_data['mimetype'] in self.mimemap:
-                        mime_ext = self.mimemap[datastream_data['mimetype']]
-                    destination = f"{row['nid']}_{original_file}{mime_ext}"
-                    shutil.copy(source, f"{filepath}/{destination}")
-                    writer.writerow({'node_id': row['nid'], 'file': destination})
+        # Rows wait here until their files have staged, so the sheet never lists a file that failed.
+        pending = {}
+        with ChunkedSheet(sheetpath, filepath, output_file_name, headers, max_rows, max_bytes,
+                          append=resume, key='node_id') as sheet:
+            self.journal.before_commit.append(sheet.sync)
+            with StagingEngine(self.su.staging_threads, strategy=self.su.link_strategy) as engine:
+                for row in cursor.execute(statement):
+                    if row['pid'] in done:
+                        continue
+                    # Staged and written before a crash, but the journal commit was lost.
+                    if str(row['nid']) in sheet.existing:
+                        self.journal.record(operation, row['pid'], 'done')
+                        continue
+                    foxml_file = self.su.dereference(row['pid'])
+                    foxml = f"{self.objectStore}/{foxml_file}"
+                    fw = FW.FWorker(foxml)
+                    if fw.properties['state'] != 'Active':
+                        self.journal.record(operation, row['pid'], 'done')
+                        continue
+                    all_datastreams = fw.get_file_data()
+                    original_file = False
+                    if 'PDF' in all_datastreams:
+                        original_file = 'PDF'
+                    if 'OBJ' in all_datastreams:
+                        original_file = 'OBJ'
+                    if original_file in all_datastreams:
+                        datastream_data = all_datastreams[original_file]
+                        source = f"{self.datastreamStore}/{self.su.dereference(datastream_data['filename'])}"
+                        mime_ext = '.bin'
+                        if datastream_data['mimetype'] in self.mimemap:
+                            mime_ext = self.mimemap[datastream_data['mimetype']]
+                        size = Path(source).stat().st_size if max_bytes and Path(source).exists() else 0
+                        destination, file_value = sheet.place(f"{row['nid']}_{original_file}{mime_ext}", size)
+                        pending[row['pid']] = ({'node_id': row['nid'], 'file': file_value}, sheet.chunk)
+                        engine.copy(row['pid'], source, destination)
+                    else:
+                        self.journal.record(operation, row['pid'], 'done')
+                    self.record_staged(operation, sheet, pending, engine.drain())
+            self.record_staged(operation, sheet, pending, engine.drain())
+            self.journal.commit()
+            self.journal.before_commit.remove(sheet.sync)
+        print(f"Wrote {len(sheet.sheets)} sheets: {sheet.sheets}")
         self.conn.close()
 
-    def build_workbench_mods_sheet_remote(self):
-        output_file_name = f"imagined_add_mods_workbench.csv"
+    # Writes the sheet rows of staged objects and journals every finished copy.
+    def record_staged(self, operation, sheet, pending, finished):
+        for pid, status, checksum in finished:
+            row, chunk = pending.pop(pid)
+            if status == 'done':
+                sheet.writerow(row, chunk)
+            self.journal.record(operation, pid, status, checksum)
+
+    # With max_rows or max_bytes the sheet is split into chunks with matching file subdirectories.
+    def build_workbench_mods_sheet_remote(self, max_rows=None, max_bytes=None):
+        output_file_name = f"imagined_add_mods_workbench"
         cursor = self.conn.cursor()
         statement = f"""
-                   SELECT nid, mods
+                   SELECT nid, mods, mods_hash
                    FROM imagined
                    WHERE nid IS NOT NULL
            """
         headers = ['node_id', 'file']
         filepath = 'workbench_files'
         sheetpath = 'workbench_sheets'
-        # Build directory
-        Path(filepath).mkdir(parents=True, exist_ok=True)
-        Path(sheetpath).mkdir(parents=True, exist_ok=True)
-        with open(f"{sheetpath}/{output_file_name}", 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=headers)
-            writer.writeheader()
+        with ChunkedSheet(sheetpath, filepath, output_file_name, headers, max_rows, max_bytes) as sheet:
             for row in cursor.execute(statement):
-                if row['mods']:
-                    filename = f"{row['nid'].replace(':', '_')}_mods.xml"
-                    with open(f"{filepath}/{filename}", "w") as text_file:
-                        text_file.write(row['mods'])
-                    writer.writerow({'node_id': row['nid'], 'file': filename})
+                mods = self.su.blobs.resolve(row['mods'], row['mods_hash'])
+                if mods:
+                    data = mods.encode('utf-8')
+                    destination, file_value = sheet.place(f"{row['nid'].replace(':', '_')}_mods.xml", len(data))
+                    with open(destination, "wb") as text_file:
+                        text_file.write(data)
+                    sheet.writerow({'node_id': row['nid'], 'file': file_value})
+        print(f"Wrote {len(sheet.sheets)} sheets: {sheet.sheets}")
         self.conn.close()
 
     def build(self, csv_file):
@@ -184,28 +207,26 @@ class ScholarProcessor:
 
     def make_media_delete_sheet(self, filename):
         with open(filename, 'r') as file:
-            # Iterate over each line in the file
-            with open('outputs/delete_node_media.csv', 'w') as outfile:
-                outfile.write('node_id\n')
-                for line in file:
-                    identifier = line.split('_')[1]
-                    pid = f'imagined:{identifier}'
-                    nid = self.su.get_nid_from_pid('imagined', pid)
-                    outfile.write(nid + '\n')
+            pids = [f"imagined:{line.split('_')[1]}" for line in file]
+        nids = self.su.get_nids_for_pids('imagined', pids)
+        with open('outputs/delete_node_media.csv', 'w') as outfile:
+            outfile.write('node_id\n')
+            for pid in pids:
+                outfile.write(nids[pid] + '\n')
 
-    def prepare_page_worksheet(self, output_file):
-        details = self.mu.get_page_details('msvu')
-        with open(output_file, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=self.fieldnames)
-            writer.writeheader()
-            for detail in details:
-                mods = self.mu.extract_from_mods(detail['field_pid'])
-                row = mods | detail
-                node_id = self.mu.get_nid_from_pid('msvu', row['field_member_of'])
-                row['id'] = row['field_pid']
-                if node_id:
-                    row['field_member_of'] = node_id
-                    writer.writerow(row)
+    def prepare_page_worksheet(self, output_file, namespace='msvu'):
+        details = self.su.get_page_details(namespace)
+        nids = self.su.get_nid_map(namespace)
+        rows = []
+        for detail in details:
+            mods = self.su.extract_from_mods(detail['field_pid'], namespace)
+            row = mods | detail
+            node_id = nids.get(row['field_member_of'])
+            row['id'] = row['field_pid']
+            if node_id:
+                row['field_member_of'] = node_id
+                rows.append(row)
+        self.su.write_union_csv(rows, output_file)
 
 
 if __name__ == '__main__':
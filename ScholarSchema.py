@@ -0,0 +1,144 @@
+import sqlite3
+import RelsGraph
+
+# Bump when adding a migration below; stored in the database as PRAGMA user_version.
+SCHEMA_VERSION = 3
+
+# Columns every object table (islandscholar, imagined, ivoices, institution tables) should have.
+OBJECT_COLUMNS = {
+    'nid': 'TEXT',
+    'content_model': 'TEXT',
+    'collection_pid': 'TEXT',
+    'page_of': 'TEXT',
+    'sequence': 'TEXT',
+    'constituent_of': 'TEXT',
+    'mods': 'TEXT',
+    'dublin_core': 'TEXT',
+    'mods_hash': 'TEXT',
+    'dublin_core_hash': 'TEXT',
+}
+
+# Indexes for the columns the hot queries filter on; the nid index covers the workbench exports.
+INDEXES = {
+    'collection_pid': 'collection_pid',
+    'content_model': 'content_model',
+    'nid': 'nid, pid, content_model',
+}
+
+# RELS-EXT predicate behind each denormalized object table column.
+RELS_COLUMNS = {
+    'collection_pid': 'isMemberOfCollection',
+    'content_model': 'hasModel',
+    'page_of': 'isPageOf',
+    'sequence': 'isSequenceNumber',
+    'constituent_of': 'isConstituentOf',
+}
+
+
+# Object tables are the ones keyed by pid that carry the RELS-EXT hierarchy.
+def object_tables(conn):
+    tables = []
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+        columns = table_columns(conn, name)
+        if 'pid' in columns and 'content_model' in columns:
+            tables.append(name)
+    return tables
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+# Adds any missing columns and the hot-query indexes to one object table. Safe to rerun.
+def ensure_object_table(conn, table):
+    columns = table_columns(conn, table)
+    for column, column_type in OBJECT_COLUMNS.items():
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    for name, columns in INDEXES.items():
+        conn.execute(f"CREATE INDEX if not exists {table}_{name} ON {table}({columns})")
+    conn.commit()
+
+
+def migrate_1(conn):
+    for table in object_tables(conn):
+        ensure_object_table(conn, table)
+
+
+# Compressed, deduplicated MODS and DC; rows reference blobs through mods_hash and dublin_core_hash.
+def migrate_2(conn):
+    conn.execute("""
+        CREATE TABLE if not exists blobs(
+        hash TEXT PRIMARY KEY,
+        codec TEXT,
+        size INTEGER,
+        data BLOB
+        )""")
+    for table in object_tables(conn):
+        ensure_object_table(conn, table)
+
+
+# Normalized RELS-EXT edges for recursive hierarchy queries, filled from the existing object tables.
+# The primary key serves lookups by subject; the indexes serve children and page listings.
+def migrate_3(conn):
+    conn.execute("""
+        CREATE TABLE if not exists rels_ext(
+        subject TEXT,
+        predicate TEXT,
+        object TEXT,
+        PRIMARY KEY (subject, predicate, object)
+        )""")
+    conn.execute("CREATE INDEX if not exists rels_ext_object ON rels_ext(object, predicate, subject)")
+    conn.execute("CREATE INDEX if not exists rels_ext_predicate ON rels_ext(predicate, object, subject)")
+    graph = RelsGraph.RelsGraph(conn)
+    for table in object_tables(conn):
+        ensure_object_table(conn, table)
+        graph.load_table(table, RELS_COLUMNS)
+
+
+MIGRATIONS = {
+    1: migrate_1,
+    2: migrate_2,
+    3: migrate_3,
+}
+
+
+# Upgrades an existing database in place to SCHEMA_VERSION.
+def upgrade(conn):
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version in sorted(MIGRATIONS):
+        if version > current:
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+            print(f"Upgraded schema to version {version}")
+
+
+# Hot queries used by staging, structure and workbench exports, with sample parameters.
+def hot_queries(table):
+    return [
+        (f"select pid, content_model from {table} where collection_pid = ?", ('collection',)),
+        (f"select pid, collection_pid from {table} where content_model in (?, ?, ?)",
+         ('islandora:collectionCModel', 'islandora:bookCModel', 'islandora:compoundCModel')),
+        (f"select nid, pid, content_model from {table} where collection_pid = ? and nid IS NOT NULL",
+         ('collection',)),
+        (f"select nid, pid, content_model from {table} where nid IS NOT NULL", ()),
+    ]
+
+
+# Runs EXPLAIN QUERY PLAN over the hot queries; returns those that would scan the whole table.
+def check_query_plans(conn, table):
+    scans = []
+    for query, params in hot_queries(table):
+        plan = [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()]
+        if any(detail.startswith('SCAN') for detail in plan):
+            scans.append((query, plan))
+            print(f"Full scan: {query} -> {plan}")
+    return scans
+
+
+if __name__ == '__main__':
+    connection = sqlite3.connect('scholar.db')
+    upgrade(connection)
+    for name in object_tables(connection):
+        check_query_plans(connection, name)
@@ -3,29 +3,146 @@
 import sqlite3
 import csv
 import hashlib
+import json
+import os
+import tempfile
 import urllib
 from pathlib import Path
 from urllib.parse import unquote
-import shutil
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
 import xml.etree.ElementTree as ET
 import re
 import ModsTransformer
+import rosies_xml2workbench
 from openpyxl.styles.builtins import currency
 
 import FoxmlWorker as FW
+from StagingEngine import StagingEngine
+import Journal
+import ScholarSchema
+from BlobStore import BlobStore
+from HarvestState import HarvestState
+import RelsGraph
 
 from saxonche import *
 import xmltodict
 import pprint
 
 
+# Streams rows into one transaction with executemany, relaxing durability for the duration of the load.
+def bulk_load(conn, statement, rows, batch_size=10000):
+    conn.commit()
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    synchronous = conn.execute("PRAGMA synchronous").fetchone()[0]
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    start = time.perf_counter()
+    count = 0
+    try:
+        with conn:
+            while batch := list(islice(rows, batch_size)):
+                conn.executemany(statement, batch)
+                count += len(batch)
+    finally:
+        conn.execute(f"PRAGMA synchronous={synchronous}")
+        conn.execute(f"PRAGMA journal_mode={journal_mode}")
+    print(f"Loaded {count} rows in {time.perf_counter() - start:.2f}s")
+    return count
+
+
+# Returns disk address from PID; the "##" pattern is the first two characters of the hash.
+# The small cache only serves repeats close together, such as a datastream dereferenced right after its object.
+@lru_cache(maxsize=65536)
+def dereference_path(identifier: str) -> str:
+    full = f"info:fedora/{identifier.replace('+', '/')}"
+    hash_value = hashlib.md5(full.encode('utf-8')).hexdigest()
+    encoded = urllib.parse.quote(full, safe='').replace('_', '%5F')
+    return f"{hash_value[:2]}/{encoded}"
+
+
+# Original implementation, kept as the baseline for benchmark_dereference.
+def legacy_dereference(identifier: str) -> str:
+    # Replace '+' with '/' in the identifier
+    slashed = identifier.replace('+', '/')
+    full = f"info:fedora/{slashed}"
+    # Generate the MD5 hash of the full string
+    hash_value = hashlib.md5(full.encode('utf-8')).hexdigest()
+    # Pattern to fill with hash (similar to the `##` placeholder)
+    subbed = "##"
+    # Replace the '#' characters in `subbed` with the corresponding characters from `hash_value`
+    hash_offset = 0
+    pattern_offset = 0
+    result = list(subbed)
+
+    while pattern_offset < len(result) and hash_offset < len(hash_value):
+        if result[pattern_offset] == '#':
+            result[pattern_offset] = hash_value[hash_offset]
+            hash_offset += 1
+        pattern_offset += 1
+
+    subbed = ''.join(result)
+    # URL encode the full string, replacing '_' with '%5F'
+    encoded = urllib.parse.quote(full, safe='').replace('_', '%5F')
+    return f"{subbed}/{encoded}"
+
+
+# Builds a RELS-EXT row for one object; module level so it can run in a worker process.
+def relations_row(job):
+    pid, foxml, rels_map = job
+    fw = FW.FWorker(foxml)
+    if fw.get_state() != 'Active':
+        return None
+    row = {'pid': pid}
+    for relation, value in fw.get_rels_ext_values().items():
+        if relation in rels_map:
+            row[rels_map[relation]] = value
+    return row
+
+
+# Reads the RELS-EXT edges of one object; module level so it can run in a worker process.
+def rels_ext_edges(job):
+    pid, foxml = job
+    fw = FW.FWorker(foxml)
+    if fw.get_state() != 'Active':
+        return pid, None
+    return pid, fw.get_rels_ext_values()
+
+
+# Orders isSequenceNumber values numerically, with blank or non-numeric values first.
+def sequence_key(sequence):
+    sequence = (sequence or '').strip()
+    return int(sequence) if sequence.isdigit() else -1
+
+
+# Resolves the MODS for one object, managed or inline; module level so it can run in a worker process.
+def read_mods(job):
+    pid, foxml, datastream_store = job
+    try:
+        fw = FW.FWorker(foxml)
+        if fw.get_state() != 'Active':
+            return pid, 'done', ''
+        mods_info = fw.get_file_data().get('MODS')
+        if mods_info:
+            return pid, 'done', Path(f"{datastream_store}/{dereference_path(mods_info['filename'])}").read_text()
+        return pid, 'done', fw.get_inline_mods()
+    except Exception as e:
+        return pid, 'failed', str(e)
+
+
 class ScholarUtilities:
 
     def __init__(self):
         self.objectStore = '/usr/local/fedora/data/objectStore'
         self.datastreamStore = '/usr/local/fedora/data/datastreamStore'
-        self.conn = sqlite3.connect('scholar.db')
+        # Shared with single-writer threads; only one thread writes at a time.
+        self.conn = sqlite3.connect('scholar.db', check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
+        ScholarSchema.upgrade(self.conn)
         self.rels_map = {'isMemberOfCollection': 'collection_pid',
                          'isMemberOf': 'collection_pid',
                          'hasModel': 'content_model',
@@ -60,73 +177,200 @@ class ScholarUtilities:
                         "application/msword": ".doc"
                         }
         self.staging_dir = '/usr/local/fedora/upei_migrations/staging'
+        self.staging_threads = 8
+        # One of auto, reflink, hardlink, copy_file_range or copy. auto never hardlinks.
+        self.link_strategy = 'auto'
         self.mt = ModsTransformer.ModsTransformer()
+        self.journal = Journal.Journal(self.conn)
+        self.nid_maps = {}
+        self.blobs = BlobStore(self.conn)
+        self.graph = RelsGraph.RelsGraph(self.conn)
+        # Store MODS and DC as compressed, deduplicated blobs instead of inline text.
+        self.compress_metadata = False
+        self.saxon = None
+        self.mods_executable = None
+        # List PIDS from the objectStore manifest instead of crawling the objectStore on every harvest.
+        self.use_manifest = True
 
     # Returns disk address from PID.
     def dereference(self, identifier: str) -> str:
-        # Replace '+' with '/' in the identifier
-        slashed = identifier.replace('+', '/')
-        full = f"info:fedora/{slashed}"
-        # Generate the MD5 hash of the full string
-        hash_value = hashlib.md5(full.encode('utf-8')).hexdigest()
-        # Pattern to fill with hash (similar to the `##` placeholder)
-        subbed = "##"
-        # Replace the '#' characters in `subbed` with the corresponding characters from `hash_value`
-        hash_offset = 0
-        pattern_offset = 0
-        result = list(subbed)
-
-        while pattern_offset < len(result) and hash_offset < len(hash_value):
-            if result[pattern_offset] == '#':
-                result[pattern_offset] = hash_value[hash_offset]
-                hash_offset += 1
-            pattern_offset += 1
-
-        subbed = ''.join(result)
-        # URL encode the full string, replacing '_' with '%5F'
-        encoded = urllib.parse.quote(full, safe='').replace('_', '%5F')
-        return f"{subbed}/{encoded}"
-
-    # Gets PIDS, filtered by namespace directly from objectStore
-    def get_pids_from_objectstore(self, namespace=''):
-        wildcard = '*/*'
+        return dereference_path(identifier)
+
+    # Returns disk addresses for many PIDs or datastream identifiers.
+    def dereference_many(self, identifiers) -> list:
+        return list(map(dereference_path, identifiers))
+
+    # Compares the original per-character dereference with the new version over one cold pass each,
+    # as a migration run dereferences each PID about once.
+    def benchmark_dereference(self, csv_file='assets/scholar_nid_pid.csv'):
+        with open(csv_file, newline='') as csvfile:
+            pids = [row['pid'] for row in csv.DictReader(csvfile)]
+        start = time.perf_counter()
+        for pid in pids:
+            legacy_dereference(pid)
+        before = len(pids) / (time.perf_counter() - start)
+        dereference_path.cache_clear()
+        start = time.perf_counter()
+        self.dereference_many(pids)
+        after = len(pids) / (time.perf_counter() - start)
+        print(f"{len(pids)} PIDs, one cold pass")
+        print(f"Before: {before:,.0f} calls/sec")
+        print(f"After: {after:,.0f} calls/sec ({after / before:.1f}x) {dereference_path.cache_info()}")
+
+    # Yields PIDS, filtered by namespace, from the manifest or, with use_manifest = False,
+    # by crawling the objectStore.
+    def iter_pids(self, namespace=''):
+        if self.use_manifest:
+            return iter(self.manifest_pids(namespace))
+        return self.scan_pids(namespace)
+
+    # Refreshes the manifest incrementally and returns its PIDS, filtered by namespace.
+    def manifest_pids(self, namespace=''):
+        self.refresh_manifest()
+        cursor = self.conn.cursor()
         if namespace:
-            wildcard = f'*/*{namespace}*'
-        pids = []
-        for p in Path(self.objectStore).rglob(wildcard):
-            pid = unquote(p.name).replace('info:fedora/', '')
-            pids.append(pid)
-        return pids
-
-    # Gets RELS-EXT relationships from objectStore
-    def build_record_from_pids(self, namespace, output_file):
-        pids = self.get_pids_from_objectstore(namespace)
+            cursor.execute("SELECT pid FROM objectstore_manifest WHERE namespace = ?", (namespace,))
+        else:
+            cursor.execute("SELECT pid FROM objectstore_manifest")
+        return [row[0] for row in cursor]
+
+    # Yields PIDS, filtered by namespace, as they are found in the objectStore
+    def scan_pids(self, namespace=''):
+        with os.scandir(self.objectStore) as buckets:
+            for bucket in buckets:
+                if not bucket.is_dir():
+                    continue
+                with os.scandir(bucket.path) as entries:
+                    for entry in entries:
+                        pid = unquote(entry.name).replace('info:fedora/', '')
+                        if namespace and pid.split(':')[0] != namespace:
+                            continue
+                        yield pid
+
+    # Gets PIDS, filtered by namespace, from the manifest table or directly from the objectStore;
+    # from_manifest overrides use_manifest.
+    def get_pids_from_objectstore(self, namespace='', from_manifest=None):
+        if from_manifest is None:
+            from_manifest = self.use_manifest
+        if from_manifest:
+            return self.manifest_pids(namespace)
+        return list(self.scan_pids(namespace))
+
+    def create_manifest(self):
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            CREATE TABLE if not exists objectstore_manifest(
+            pid TEXT PRIMARY KEY,
+            namespace TEXT,
+            foxml TEXT,
+            bucket TEXT,
+            mtime REAL,
+            size INTEGER,
+            state TEXT
+            )""")
+        cursor.execute("""
+            CREATE TABLE if not exists objectstore_buckets(
+            bucket TEXT PRIMARY KEY,
+            mtime REAL
+            )""")
+        cursor.execute("CREATE INDEX if not exists objectstore_manifest_namespace ON objectstore_manifest(namespace)")
+        cursor.execute("CREATE INDEX if not exists objectstore_manifest_bucket ON objectstore_manifest(bucket)")
+        self.conn.commit()
+
+    # Brings the manifest up to date, rescanning only buckets whose directory mtime has changed.
+    # Fedora replaces FOXML files rather than rewriting them in place, so any change touches the bucket.
+    def refresh_manifest(self):
+        self.create_manifest()
+        cursor = self.conn.cursor()
+        known_buckets = {row['bucket']: row['mtime'] for row in
+                         cursor.execute("SELECT bucket, mtime FROM objectstore_buckets")}
+        seen_buckets = set()
+        rescanned = 0
+        with os.scandir(self.objectStore) as buckets:
+            for bucket in buckets:
+                if not bucket.is_dir():
+                    continue
+                seen_buckets.add(bucket.name)
+                bucket_mtime = bucket.stat().st_mtime
+                if known_buckets.get(bucket.name) == bucket_mtime:
+                    continue
+                self.refresh_manifest_bucket(bucket)
+                cursor.execute("INSERT OR REPLACE INTO objectstore_buckets VALUES(?, ?)",
+                               (bucket.name, bucket_mtime))
+                rescanned += 1
+        for bucket in set(known_buckets) - seen_buckets:
+            cursor.execute("DELETE FROM objectstore_manifest WHERE bucket = ?", (bucket,))
+            cursor.execute("DELETE FROM objectstore_buckets WHERE bucket = ?", (bucket,))
+        self.conn.commit()
+        print(f"Manifest refreshed, {rescanned} of {len(seen_buckets)} buckets rescanned")
+
+    def refresh_manifest_bucket(self, bucket):
+        cursor = self.conn.cursor()
+        known = {row['pid']: (row['mtime'], row['size']) for row in
+                 cursor.execute("SELECT pid, mtime, size FROM objectstore_manifest WHERE bucket = ?", (bucket.name,))}
+        present = set()
+        with os.scandir(bucket.path) as entries:
+            for entry in entries:
+                pid = unquote(entry.name).replace('info:fedora/', '')
+                present.add(pid)
+                stat = entry.stat()
+                if known.get(pid) == (stat.st_mtime, stat.st_size):
+                    continue
+                try:
+                    state = FW.FWorker(entry.path, streaming=True).get_state()
+                except Exception:
+                    state = None
+                cursor.execute("INSERT OR REPLACE INTO objectstore_manifest VALUES(?, ?, ?, ?, ?, ?, ?)",
+                               (pid, pid.split(':')[0], entry.path, bucket.name, stat.st_mtime, stat.st_size,
+                                state))
+        for pid in set(known) - present:
+            cursor.execute("DELETE FROM objectstore_manifest WHERE pid = ?", (pid,))
+
+    # Gets RELS-EXT relationships from objectStore, parsing across worker processes if workers > 1.
+    # With delta=True only objects whose FOXML changed since the last delta run are written.
+    def build_record_from_pids(self, namespace, output_file, workers=1, delta=False):
+        state = HarvestState(self.conn, f"build_record:{namespace}") if delta else None
         headers = ['pid',
                    'content_model',
                    'collection_pid',
                    'page_of',
                    'sequence',
                    'constituent_of']
-
+        jobs = ((pid, f"{self.objectStore}/{self.dereference(pid)}", self.rels_map)
+                for pid in self.iter_pids(namespace))
+        if delta:
+            jobs = (job for job in jobs if state.changed(job[0], job[1]))
+        start = time.perf_counter()
+        processed = 0
         with open(output_file, 'w', newline='') as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=headers)
             writer.writeheader()
-            for pid in pids:
-                foxml_file = self.dereference(pid)
-                foxml = f"{self.objectStore}/{foxml_file}"
-                fw = FW.FWorker(foxml)
-                if fw.get_state() != 'Active':
-                    continue
-                relations = fw.get_rels_ext_values()
-                row = {}
-                row['pid'] = pid
-                for relation, value in relations.items():
-                    if relation in self.rels_map:
-                        row[self.rels_map[relation]] = value
-                writer.writerow(row)
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    # Submit in bounded batches so PIDs are consumed lazily;
+                    # map yields in submission order, so output is deterministic.
+                    while batch := list(islice(jobs, workers * 256)):
+                        for job, row in zip(batch, executor.map(relations_row, batch, chunksize=64)):
+                            processed += 1
+                            if row:
+                                writer.writerow(row)
+                            if delta:
+                                state.save(job[0])
+            else:
+                for job in jobs:
+                    processed += 1
+                    row = relations_row(job)
+                    if row:
+                        writer.writerow(row)
+                    if delta:
+                        state.save(job[0])
+        elapsed = time.perf_counter() - start
+        print(f"Processed {processed} objects in {elapsed:.1f}s ({processed / max(elapsed, 1e-9):.1f} objects/sec)")
+        if delta:
+            state.write_deleted(str(Path(output_file).with_suffix('.deleted.txt')))
 
     # Processes CSV returned from direct objectStore harvest
-    def process_clean_institution(self, institution, csv_file):
+    def process_clean_institution(self, institution, csv_file, batch_size=10000):
         cursor = self.conn.cursor()
         cursor.execute(f"""
             CREATE TABLE if not exists {institution}(
@@ -135,82 +379,300 @@ class ScholarUtilities:
             collection_pid TEXT,
             page_of TEXT,
             sequence TEXT,
-            constituent_of TEXT
+            constituent_of TEXT,
+            mods TEXT,
+            dublin_core TEXT
             )""")
         self.conn.commit()
+        ScholarSchema.ensure_object_table(self.conn, institution)
         with open(csv_file, newline='') as csvfile:
             reader = csv.DictReader(csvfile)
-            for row in reader:
-                collection = row['collection_pid']
-                page_of = row['page_of']
-                if not page_of:
-                    page_of = ' '
-                constituent_of = row['constituent_of']
-                if not constituent_of:
-                    constituent_of = ' '
-                try:
-                    command = f"INSERT OR REPLACE INTO  {institution} VALUES('{row['pid']}', '{row['content_model']}', '{collection}','{page_of}', '{row['sequence']}','{constituent_of}','','')"
-                    cursor.execute(command)
-                except sqlite3.Error:
-                    print(command)
+            rows = ((row['pid'], row['content_model'], row['collection_pid'], row['page_of'] or ' ',
+                     row['sequence'], row['constituent_of'] or ' ', '', '') for row in reader)
+            bulk_load(self.conn, f"""INSERT OR REPLACE INTO {institution}
+                (pid, content_model, collection_pid, page_of, sequence, constituent_of, mods, dublin_core)
+                VALUES(?, ?, ?, ?, ?, ?, ?, ?)""", rows, batch_size)
+        self.graph.load_table(institution, ScholarSchema.RELS_COLUMNS)
+
+    # Indexes RELS-EXT edges straight from the objectStore, parsing across worker processes if workers > 1.
+    def index_rels_ext(self, namespace, workers=1, batch_size=5000):
+        jobs = ((pid, f"{self.objectStore}/{self.dereference(pid)}") for pid in self.iter_pids(namespace))
+        if workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            results = (result for batch in iter(lambda: list(islice(jobs, workers * 256)), [])
+                       for result in executor.map(rels_ext_edges, batch, chunksize=64))
+        else:
+            executor = None
+            results = map(rels_ext_edges, jobs)
+        indexed = 0
+        try:
+            for pid, values in results:
+                if values is not None:
+                    self.graph.replace(pid, values)
+                    indexed += 1
+                    if indexed % batch_size == 0:
+                        self.conn.commit()
+        finally:
+            if executor:
+                executor.shutdown()
         self.conn.commit()
-
-    # Adds all MODS records from datastreamStore to database
-    def add_mods_to_database(self, namespace):
-        cursor = self.conn.cursor()
-        pids = self.get_pids_from_objectstore(namespace)
-        for pid in pids:
-            foxml_file = self.dereference(pid)
-            foxml = f"{self.objectStore}/{foxml_file}"
-            fw = FW.FWorker(foxml)
-            if fw.get_state() != 'Active':
-                continue
-            mapping = fw.get_file_data()
-            mods_info = mapping.get('MODS')
-            if mods_info:
-                mods_path = f"{self.datastreamStore}/{self.dereference(mods_info['filename'])}"
-                mods_xml = Path(mods_path).read_text()
+        print(f"Indexed RELS-EXT for {indexed} objects")
+
+    # Adds all MODS records from datastreamStore to database.
+    # Worker processes parse FOXML and read MODS; one writer thread owns every database write.
+    # With delta=True only objects whose FOXML changed since the last delta run are reloaded.
+    # Delta runs save each signature with its batch, so rerunning with delta alone resumes them;
+    # combined with resume, journal-skipped objects would never get a signature and never settle.
+    def add_mods_to_database(self, namespace, resume=False, delta=False, workers=1, batch_size=5000):
+        if resume and delta:
+            raise ValueError("resume and delta cannot be combined; rerun with delta=True to resume a delta run")
+        operation = f"add_mods:{namespace}"
+        done = self.journal.completed(operation) if resume else set()
+        state = HarvestState(self.conn, operation) if delta else None
+        jobs = ((pid, f"{self.objectStore}/{self.dereference(pid)}", self.datastreamStore)
+                for pid in self.iter_pids(namespace))
+        if delta:
+            jobs = (job for job in jobs if state.changed(job[0], job[1]))
+        jobs = (job for job in jobs if job[0] not in done)
+        results = queue.Queue(maxsize=batch_size * 2)
+        died = threading.Event()
+        errors = []
+        writer = threading.Thread(target=self.run_writer,
+                                  args=(died, errors, self.write_mods, namespace, operation, state, results, batch_size))
+        writer.start()
+        try:
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    while batch := list(islice(jobs, workers * 256)):
+                        for result in executor.map(read_mods, batch, chunksize=64):
+                            self.put_result(results, died, errors, result)
             else:
-                mods_xml = fw.get_inline_mods()
-            if mods_xml:
-                mods_xml = mods_xml.replace("'", "''")
-                command = f"""UPDATE {namespace} set mods = '{mods_xml}' where pid = '{pid}'"""
-                cursor.execute(command)
-        self.conn.commit()
+                for job in jobs:
+                    self.put_result(results, died, errors, read_mods(job))
+        finally:
+            if not died.is_set():
+                self.put_result(results, died, errors, None)
+            writer.join()
+        if errors:
+            raise errors[0]
+        if delta:
+            Path(self.staging_dir).mkdir(parents=True, exist_ok=True)
+            state.write_deleted(f"{self.staging_dir}/{namespace}_deleted.txt")
+
+    # Runs a single-writer thread, recording its exception so producers stop and the caller can re-raise it.
+    def run_writer(self, died, errors, target, *args):
+        try:
+            target(*args)
+        except BaseException as e:
+            errors.append(e)
+            died.set()
+
+    # Queues a result for the writer; raises the writer's exception instead of blocking forever once it has died.
+    def put_result(self, results, died, errors, result):
+        while not died.is_set():
+            try:
+                results.put(result, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise errors[0]
+
+    # Single writer for add_mods_to_database, applying results in batched transactions.
+    def write_mods(self, namespace, operation, state, results, batch_size):
+        start = time.perf_counter()
+        processed = 0
+        failed = 0
+        updates = []
+        entries = []
+        while True:
+            result = results.get()
+            if result is not None:
+                pid, status, mods_xml = result
+                processed += 1
+                if status == 'failed':
+                    failed += 1
+                    print(f"{pid}: {mods_xml}")
+                    entries.append((pid, status, ''))
+                elif mods_xml:
+                    updates.append((pid, mods_xml))
+                    entries.append((pid, status, Journal.checksum(mods_xml)))
+                else:
+                    entries.append((pid, status, ''))
+            if entries and (result is None or len(entries) >= batch_size):
+                with self.conn:
+                    self.store_metadata_many(namespace, 'mods', updates)
+                    self.journal.record_many(operation, entries)
+                    if state:
+                        state.save_many(pid for pid, status, _ in entries if status == 'done')
+                updates = []
+                entries = []
+                elapsed = time.perf_counter() - start
+                print(f"{processed} objects, {failed} failed ({processed / max(elapsed, 1e-9):.1f} objects/sec)")
+            if result is None:
+                return
+
+    # Compiles the MODS stylesheet on first use and keeps it for the life of the instance.
+    def get_mods_executable(self):
+        if self.mods_executable is None:
+            self.saxon = PySaxonProcessor(license=False)
+            xsltproc = self.saxon.new_xslt30_processor()
+            self.mods_executable = xsltproc.compile_stylesheet(stylesheet_file=self.mods_xsl)
+            self.mods_executable.set_base_output_uri(Path(self.staging_dir).resolve().as_uri() + '/')
+        # relatedItem rows are xsl:result-documents; capture them in memory instead of writing files.
+        # Re-arming the capture clears the documents left by the previous transform.
+        self.mods_executable.set_capture_result_documents(True)
+        return self.mods_executable
+
+    # Transforms one MODS record in memory; returns the principal <row> element and the captured
+    # relatedItem rows keyed by the file name the stylesheet gave them.
+    def transform_mods_rows(self, pid, mods):
+        executable = self.get_mods_executable()
+        builder = self.saxon.new_document_builder()
+        # The stylesheet derives field_pid from the source file name, as in namespace_id_MODS.xml.
+        builder.set_base_uri(Path(self.staging_dir, f"{pid.replace(':', '_')}_MODS.xml").resolve().as_uri())
+        document = builder.parse_xml(xml_text=mods)
+        row = ET.fromstring(executable.transform_to_string(xdm_node=document))
+        related = {uri.rsplit('/', 1)[-1]: ET.fromstring(str(value))
+                   for uri, value in executable.get_result_documents().items()}
+        return row, related
+
+    # Yields (pid, MODS) for a table, or straight from the datastreamStore when a namespace is given.
+    def iter_mods(self, table, namespace=None):
+        if namespace is None:
+            cursor = self.conn.cursor()
+            for row in cursor.execute(f"select pid, mods, mods_hash from {table}"):
+                yield row['pid'], self.blobs.resolve(row['mods'], row['mods_hash'])
+            return
+        for pid in self.iter_pids(namespace):
+            pid, status, mods = read_mods((pid, f"{self.objectStore}/{self.dereference(pid)}", self.datastreamStore))
+            if status == 'failed':
+                print(f"{pid}: {mods}")
+                continue
+            yield pid, mods
 
-    def extract_from_mods(self, pid):
-        cursor = self.conn.cursor()
-        command = f"SELECT MODS from IMAGINED where PID = '{pid}'"
-        mods = cursor.execute(command).fetchone()['MODS']
+    # MODS -> rosies_transform.xsl -> rosies_xml2workbench cleaning -> workbench CSV in one pass,
+    # with no intermediate XML files on disk. relatedItem rows are not part of the object sheet.
+    def build_workbench_csv(self, table, output_file, namespace=None):
+        rows = ((pid, self.transform_mods_rows(pid, mods)[0])
+                for pid, mods in self.iter_mods(table, namespace) if mods and len(mods) >= 10)
+        rosies_xml2workbench.process_rows(rows, output_file, **rosies_xml2workbench.load_options())
+
+    # Transforms a MODS string with the cached stylesheet.
+    def transform_mods(self, pid, mods):
         if not mods:
             return {}
-        with PySaxonProcessor(license=False) as proc:
-            xsltproc = proc.new_xslt30_processor()
-            document = proc.parse_xml(xml_text=mods)
-            executable = xsltproc.compile_stylesheet(stylesheet_file=self.mods_xsl)
-            output = executable.transform_to_string(xdm_node=document)
+        executable = self.get_mods_executable()
+        document = self.saxon.parse_xml(xml_text=mods)
+        output = executable.transform_to_string(xdm_node=document)
         result = xmltodict.parse(output)['row']
         result['field_pid'] = pid
         return result
 
-    # Gets the repository structural elements.Ò
-    def get_structure(self, table, output_file):
+    # IMAGINED variant, transforms MODS with rosies_transform.xsl.
+    def extract_from_mods_xslt(self, pid):
+        mods = self.get_metadata('imagined', pid, 'mods')
+        return self.transform_mods(pid, mods)
+
+    # Fetches MODS for many PIDs in chunked queries and transforms them with the cached stylesheet.
+    def extract_many(self, pids, table='imagined', chunk_size=500):
         cursor = self.conn.cursor()
-        all_rows = []
-        headers = []
+        results = {}
+        pids = iter(pids)
+        while chunk := list(islice(pids, chunk_size)):
+            placeholders = ', '.join('?' * len(chunk))
+            statement = f"SELECT pid, mods, mods_hash FROM {table} WHERE pid IN ({placeholders})"
+            for row in cursor.execute(statement, chunk):
+                mods = self.blobs.resolve(row['mods'], row['mods_hash'])
+                results[row['pid']] = self.transform_mods(row['pid'], mods)
+        return results
+
+    # Gets the repository structural elements, for the whole table or below one root collection.
+    # Rows are ordered by RELS-EXT level so collections come before the books and compounds they hold.
+    def get_structure(self, table, output_file, root=None):
         container_types = ['islandora:collectionCModel', 'islandora:bookCModel', 'islandora:compoundCModel']
-        statement = f"select pid, collection_pid from {table} where content_model in {str(tuple(container_types))}"
-        for row in cursor.execute(statement):
-            all_rows.append(dict(row) | self.extract_from_mods(row['pid']))
-            for row in all_rows:
-                for key, value in row.items():
-                    if key not in headers:
-                        headers.append(key)
-        with open(output_file, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=headers)
-            writer.writeheader()
-            for row in all_rows:
-                writer.writerow(row)
+        if root:
+            containers = [(pid, parents) for pid, parents, content_model
+                          in self.graph.members(root, container_types, RelsGraph.CONTAINER_PREDICATES[:2])]
+        else:
+            cursor = self.conn.cursor()
+            statement = f"select pid, collection_pid from {table} where content_model in {str(tuple(container_types))}"
+            containers = [(row['pid'], row['collection_pid']) for row in cursor.execute(statement)]
+        levels = self.graph.levels(pid for pid, parent in containers)
+        containers.sort(key=lambda container: (levels[container[0]], container[0]))
+        rows = ({'pid': pid, 'collection_pid': parent} | self.extract_from_mods(pid, table)
+                for pid, parent in containers)
+        self.write_union_csv(rows, output_file)
+
+    # Writes the next RELS-EXT level of a table (or of everything below root) as a workbench CSV:
+    # collections, then books and compounds, then pages and constituents. Only objects without a nid are
+    # written, and field_member_of is filled from the parents' node ids as they are now, so run it again
+    # after each level has been ingested and its pid -> nid mapping loaded (add_pid_mapping).
+    # Objects in one level can be ingested in parallel. Pass level to write a specific one.
+    def export_levels(self, table, output_dir, root=None, level=None):
+        cursor = self.conn.cursor()
+        objects = {row['pid']: row for row in
+                   cursor.execute(f"select pid, nid, content_model, sequence from {table}")}
+        if root:
+            below = {pid for pid, parent, depth in self.graph.descendants(root)}
+            objects = {pid: row for pid, row in objects.items() if pid in below}
+        levels = self.graph.levels(objects)
+        remaining = [levels[pid] for pid, row in objects.items() if not row['nid']]
+        if level is None:
+            if not remaining:
+                print(f"Every level of {table} has been migrated")
+                return None
+            level = min(remaining)
+        pids = [pid for pid, row in objects.items() if levels[pid] == level and not row['nid']]
+        parents = {pid: self.graph.parents(pid) for pid in pids}
+        nids = self.get_nids_for_pids(table, {parent for pid in pids for parent in parents[pid]})
+        unmigrated = sorted({parent for pid in pids for parent in parents[pid]
+                             if parent in objects and not nids.get(parent)})
+        if unmigrated:
+            print(f"{len(unmigrated)} parents have no node id yet; ingest the previous level and load its "
+                  f"mapping first: {unmigrated[:10]}")
+        # Keep each book's pages together and in sequence.
+        pids.sort(key=lambda pid: (parents[pid][:1], sequence_key(objects[pid]['sequence']), pid))
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        output_file = f"{output_dir}/{table}_level_{level}.csv"
+        rows = (self.level_row(table, objects[pid], parents[pid], nids) for pid in pids)
+        self.write_union_csv(rows, output_file)
+        print(f"Level {level}: {len(pids)} objects -> {output_file}")
+        return output_file
+
+    # One export_levels row; field_member_of holds the node ids of the parents already migrated.
+    def level_row(self, table, row, parents, nids):
+        return {'id': row['pid'],
+                'field_member_of': '|'.join(str(nids[parent]) for parent in parents if nids.get(parent)),
+                'field_weight': (row['sequence'] or '').strip(),
+                'content_model': row['content_model']} | self.extract_from_mods(row['pid'], table)
+
+    # Pages of every book in a namespace, ordered by book and sequence, from the RELS-EXT graph.
+    def get_page_details(self, namespace):
+        return [{'field_pid': pid, 'field_member_of': book, 'field_weight': sequence}
+                for pid, book, sequence in self.graph.pages(namespace=namespace)]
+
+    # Converts the MODS of a whole table to workbench rows with ModsTransformer's batch engine.
+    def export_mods_rows(self, table, output_file, workers=1):
+        cursor = self.conn.cursor()
+        records = ((row['pid'], self.blobs.resolve(row['mods'], row['mods_hash']))
+                   for row in cursor.execute(f"select pid, mods, mods_hash from {table}"))
+        self.write_union_csv(self.mt.transform_many(records, workers), output_file)
+
+    # Writes rows whose keys vary to CSV with the union of their keys as header.
+    # Rows are spooled to a temp file while the header union is collected, then written out
+    # in a second pass, so the export runs in linear time and constant memory.
+    def write_union_csv(self, rows, output_file):
+        headers = {}
+        with tempfile.TemporaryFile('w+', encoding='utf-8') as spool:
+            for row in rows:
+                headers.update(dict.fromkeys(row))
+                spool.write(json.dumps(row) + '\n')
+            spool.seek(0)
+            with open(output_file, 'w', newline='') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=list(headers))
+                writer.writeheader()
+                for line in spool:
+                    writer.writerow(json.loads(line))
 
     # Take copied and pasted text from database query and transform to pid mapping.
     def text_to_csv(self, infile, outfile):
@@ -240,69 +702,74 @@ class ScholarUtilities:
                 update_statement = f"update {table} SET nid = {row['nid']} where pid = '{row['pid']}'"
                 cursor.execute(update_statement)
         self.conn.commit()
+        self.nid_maps.pop(table, None)
 
-    def stage_files(self, table, collection):
+    # Stages datastreams for a collection; with resume=True objects already staged are skipped.
+    def stage_files(self, table, collection, resume=False):
+        operation = f"stage_files:{collection}"
+        done = self.journal.completed(operation) if resume else set()
         cursor = self.conn.cursor()
         statement = f"select pid, content_model from {table} where collection_pid = '{collection}'"
-        for row in cursor.execute(statement):
-            pid = row['pid']
-            model = row['content_model']
-            copy_streams = {}
-            foxml_file = self.dereference(pid)
-            foxml = f"{self.objectStore}/{foxml_file}"
-            try:
-                fw = FW.FWorker(foxml)
-            except:
-                print(f"No record found for {pid}")
-                continue
-            path = f"{self.staging_dir}/{collection.replace(':', '_')}"
-            Path(path).mkdir(parents=True, exist_ok=True)
-            all_files = fw.get_file_data()
-            for entry, file_data in all_files.items():
-                if entry in self.stream_map[model]:
-                    copy_streams[
-                        file_data[
-                            'filename']] = f"{pid.replace(':', '_')}_{entry}{self.mimemap[file_data['mimetype']]}"
+        path = f"{self.staging_dir}/{collection.replace(':', '_')}"
+        Path(path).mkdir(parents=True, exist_ok=True)
+        with StagingEngine(self.staging_threads, strategy=self.link_strategy) as engine:
+            for row in cursor.execute(statement):
+                pid = row['pid']
+                if pid in done:
+                    continue
+                model = row['content_model']
+                foxml_file = self.dereference(pid)
+                foxml = f"{self.objectStore}/{foxml_file}"
+                try:
+                    fw = FW.FWorker(foxml)
+                except Exception:
+                    engine.fail(pid, "No record found")
+                    self.journal.record(operation, pid, 'failed')
+                    continue
+                all_files = fw.get_file_data()
+                copies = []
+                for entry, file_data in all_files.items():
+                    if entry in self.stream_map[model]:
+                        destination = f"{pid.replace(':', '_')}_{entry}{self.mimemap[file_data['mimetype']]}"
+                        copies.append((f"{self.datastreamStore}/{self.dereference(file_data['filename'])}",
+                                       f"{path}/{destination}"))
+                mods_content = ''
                 if 'MODS' in self.stream_map[model] and 'MODS' not in all_files:
                     mods_content = fw.get_inline_mods()
                     if mods_content:
                         modsfile = f"{pid.replace(':', '_')}_MODS.xml"
                         with open(f'{path}/{modsfile}', 'w') as f:
                             f.write(mods_content)
-
-            for source, destination in copy_streams.items():
-                stream_to_copy = self.dereference(source)
-                shutil.copy(f"{self.datastreamStore}/{stream_to_copy}", f"{path}/{destination}")
+                if copies:
+                    engine.stage(pid, copies)
+                else:
+                    self.journal.record(operation, pid, 'done', Journal.checksum(mods_content))
+                for finished in engine.drain():
+                    self.journal.record(operation, *finished)
+        for finished in engine.drain():
+            self.journal.record(operation, *finished)
+        self.journal.commit()
 
     def get_all_signatures(self):
         cursor = self.conn.cursor()
         statement = f"select pid, content_model from islandscholar"
-        for row in cursor.execute(statement):
-            pid = row['pid']
-            model = row['content_model']
-            copy_streams = {}
-            foxml_file = self.dereference(pid)
-            foxml = f"{self.objectStore}/{foxml_file}"
-            try:
-                fw = FW.FWorker(foxml)
-            except:
-                print(f"No record found for {pid}")
-                continue
-            path = f"{self.staging_dir}/signatures"
-            Path(path).mkdir(parents=True, exist_ok=True)
-            all_files = fw.get_file_data()
-
-            for entry, file_data in all_files.items():
-                if entry == 'SIGNATURE':
-                    copy_streams[
-                        file_data[
-                            'filename']] = f"{pid.replace(':', '_')}_{entry}{self.mimemap[file_data['mimetype']]}"
-            for source, destination in copy_streams.items():
+        path = f"{self.staging_dir}/signatures"
+        Path(path).mkdir(parents=True, exist_ok=True)
+        with StagingEngine(self.staging_threads, strategy=self.link_strategy) as engine:
+            for row in cursor.execute(statement):
+                pid = row['pid']
+                foxml_file = self.dereference(pid)
+                foxml = f"{self.objectStore}/{foxml_file}"
                 try:
-                    stream_to_copy = self.dereference(source)
-                    shutil.copy(f"{self.datastreamStore}/{stream_to_copy}", f"{path}/{destination}")
-                except FileNotFoundError as e:
-                    print(f"{pid} Error: The file was not found: {e}")
+                    fw = FW.FWorker(foxml)
+                except Exception:
+                    engine.fail(pid, "No record found")
+                    continue
+                file_data = fw.get_file_data().get('SIGNATURE')
+                if file_data:
+                    destination = f"{pid.replace(':', '_')}_SIGNATURE{self.mimemap[file_data['mimetype']]}"
+                    engine.copy(pid, f"{self.datastreamStore}/{self.dereference(file_data['filename'])}",
+                                f"{path}/{destination}")
 
     def get_nid_from_pid(self, table, pid):
         cursor = self.conn.cursor()
@@ -314,66 +781,73 @@ class ScholarUtilities:
         else:
             return None
 
+    # Loads the whole pid -> nid mapping for a table once and reuses it; nid updates drop the cached copy.
+    def get_nid_map(self, table):
+        if table not in self.nid_maps:
+            cursor = self.conn.cursor()
+            self.nid_maps[table] = {row['pid']: row['nid'] for row in cursor.execute(f"select pid, nid from {table}")}
+        return self.nid_maps[table]
+
+    # Looks up nids for many PIDS with one join against a temporary table.
+    def get_nids_for_pids(self, table, pids):
+        cursor = self.conn.cursor()
+        cursor.execute("CREATE TEMP TABLE if not exists lookup_pids(pid TEXT PRIMARY KEY)")
+        cursor.execute("DELETE FROM lookup_pids")
+        cursor.executemany("INSERT OR IGNORE INTO lookup_pids VALUES(?)", ((pid,) for pid in pids))
+        cursor.execute(f"select l.pid, t.nid from lookup_pids l join {table} t on t.pid = l.pid")
+        nids = {row['pid']: row['nid'] for row in cursor}
+        cursor.execute("DELETE FROM lookup_pids")
+        return nids
+
+    # Strategy for files that are converted or edited after staging; never a hardlink to a Fedora master.
+    def working_strategy(self):
+        return 'auto' if self.link_strategy == 'hardlink' else self.link_strategy
+
     # get all PPMs
     def harvest_ppms(self):
         cursor = self.conn.cursor()
         statement = f"select pid from imagined"
-        for row in cursor.execute(statement):
-            pid = row['pid']
-            copy_streams = {}
-            foxml_file = self.dereference(pid)
-            foxml = f"{self.objectStore}/{foxml_file}"
-            try:
-                fw = FW.FWorker(foxml)
-            except:
-                print(f"No record found for {pid}")
-                continue
-            nid = self.get_nid_from_pid('imagined', pid)
-            path = f"{self.staging_dir}/imagined_fixed"
-            Path(path).mkdir(parents=True, exist_ok=True)
-            all_files = fw.get_file_data()
-            if {'OBJ', 'LOSSLESS_JP2'}.issubset(all_files) and all_files['OBJ']['mimetype'] == 'image/jp2':
-                for entry, file_data in all_files.items():
-                    if entry == 'OBJ':
-                        copy_streams[
-                            file_data[
-                                'filename']] = f"{pid}_OBJ.ppm"
-                for source, destination in copy_streams.items():
-                    try:
-                        stream_to_copy = self.dereference(source)
-                        shutil.copy(f"{self.datastreamStore}/{stream_to_copy}", f"{path}/{destination}")
-                    except FileNotFoundError as e:
-                        print(f"{pid} Error: The file was not found: {e}")
+        path = f"{self.staging_dir}/imagined_fixed"
+        Path(path).mkdir(parents=True, exist_ok=True)
+        with StagingEngine(self.staging_threads, strategy=self.working_strategy()) as engine:
+            for row in cursor.execute(statement):
+                pid = row['pid']
+                foxml_file = self.dereference(pid)
+                foxml = f"{self.objectStore}/{foxml_file}"
+                try:
+                    fw = FW.FWorker(foxml)
+                except Exception:
+                    engine.fail(pid, "No record found")
+                    continue
+                all_files = fw.get_file_data()
+                if {'OBJ', 'LOSSLESS_JP2'}.issubset(all_files) and all_files['OBJ']['mimetype'] == 'image/jp2':
+                    file_data = all_files['OBJ']
+                    engine.copy(pid, f"{self.datastreamStore}/{self.dereference(file_data['filename'])}",
+                                f"{path}/{pid}_OBJ.ppm")
 
     def get_all_new_objs(self):
         cursor = self.conn.cursor()
         statement = f"select pid from imagined"
-        for row in cursor.execute(statement):
-            pid = row['pid']
-            copy_streams = {}
-            foxml_file = self.dereference(pid)
-            foxml = f"{self.objectStore}/{foxml_file}"
-            try:
-                fw = FW.FWorker(foxml)
-            except:
-                print(f"No record found for {pid}")
-                continue
-            nid = self.get_nid_from_pid('imagined', pid)
-            path = f"{self.staging_dir}/imagined_fixed"
-            Path(path).mkdir(parents=True, exist_ok=True)
-            all_files = fw.get_file_data()
-            if {'OBJ', 'LOSSLESS_JP2'}.issubset(all_files) and all_files['OBJ']['mimetype'] == 'image/jp2':
-                for entry, file_data in all_files.items():
-                    if entry == 'LOSSLESS_JP2':
-                        copy_streams[
-                            file_data[
-                                'filename']] = f"{nid}_OBJ{self.mimemap[file_data['mimetype']]}"
-                for source, destination in copy_streams.items():
-                    try:
-                        stream_to_copy = self.dereference(source)
-                        shutil.copy(f"{self.datastreamStore}/{stream_to_copy}", f"{path}/{destination}")
-                    except FileNotFoundError as e:
-                        print(f"{pid} Error: The file was not found: {e}")
+        path = f"{self.staging_dir}/imagined_fixed"
+        Path(path).mkdir(parents=True, exist_ok=True)
+        nids = self.get_nid_map('imagined')
+        with StagingEngine(self.staging_threads, strategy=self.working_strategy()) as engine:
+            for row in cursor.execute(statement):
+                pid = row['pid']
+                foxml_file = self.dereference(pid)
+                foxml = f"{self.objectStore}/{foxml_file}"
+                try:
+                    fw = FW.FWorker(foxml)
+                except Exception:
+                    engine.fail(pid, "No record found")
+                    continue
+                nid = nids.get(pid)
+                all_files = fw.get_file_data()
+                if {'OBJ', 'LOSSLESS_JP2'}.issubset(all_files) and all_files['OBJ']['mimetype'] == 'image/jp2':
+                    file_data = all_files['LOSSLESS_JP2']
+                    destination = f"{nid}_OBJ{self.mimemap[file_data['mimetype']]}"
+                    engine.copy(pid, f"{self.datastreamStore}/{self.dereference(file_data['filename'])}",
+                                f"{path}/{destination}")
 
     def get_all_dc(self, table):
         cursor = self.conn.cursor()
@@ -396,19 +870,39 @@ class ScholarUtilities:
                 writer.writerow({'pid': pid, 'dublin_core': dc})
 
     def add_dc(self):
-        cursor = self.conn.cursor()
         with open('inputs/ivoices_dc.csv', newline='') as csvfile:
             reader = csv.DictReader(csvfile)
             for row in reader:
-                query = "UPDATE ivoices SET dublin_core = ? WHERE pid = ?"
-                params = (row['dublin_core'], row['pid'])
-                cursor.execute(query, params)
+                self.store_metadata('ivoices', row['pid'], 'dublin_core', row['dublin_core'])
             self.conn.commit()
 
-    def get_dc_values(self, pid):
+    # Stores MODS or DC inline, or as a compressed shared blob when compress_metadata is set.
+    def store_metadata(self, table, pid, column, text):
+        if self.compress_metadata:
+            statement = f"UPDATE {table} SET {column} = NULL, {column}_hash = ? WHERE pid = ?"
+            self.conn.execute(statement, (self.blobs.put(text), pid))
+        else:
+            statement = f"UPDATE {table} SET {column} = ?, {column}_hash = NULL WHERE pid = ?"
+            self.conn.execute(statement, (text, pid))
+
+    def store_metadata_many(self, table, column, rows):
+        if self.compress_metadata:
+            statement = f"UPDATE {table} SET {column} = NULL, {column}_hash = ? WHERE pid = ?"
+            self.conn.executemany(statement, ((self.blobs.put(text), pid) for pid, text in rows))
+        else:
+            statement = f"UPDATE {table} SET {column} = ?, {column}_hash = NULL WHERE pid = ?"
+            self.conn.executemany(statement, ((text, pid) for pid, text in rows))
+
+    # Reads MODS or DC for a PID, decompressing it if it is stored as a blob.
+    def get_metadata(self, table, pid, column):
         cursor = self.conn.cursor()
-        result = cursor.execute(f"select dublin_core from ivoices where pid = '{pid}'")
-        dc = result.fetchone()['dublin_core']
+        row = cursor.execute(f"SELECT {column}, {column}_hash FROM {table} WHERE pid = ?", (pid,)).fetchone()
+        if row is None:
+            return None
+        return self.blobs.resolve(row[0], row[1])
+
+    def get_dc_values(self, pid):
+        dc = self.get_metadata('ivoices', pid, 'dublin_core')
         root = ET.fromstring(dc)
         namespaces = {
             'dc': 'http://purl.org/dc/elements/1.1/'
@@ -421,20 +915,16 @@ class ScholarUtilities:
 
         return dc_vals
 
-    def extract_from_mods(self, pid):
-        cursor = self.conn.cursor()
-        command = f"SELECT MODS from ivoices where PID = '{pid}'"
-        result = cursor.execute(command).fetchone()
-        mods = result['MODS']
-        if mods is not None and len(mods) < 10:
+    def extract_from_mods(self, pid, table='ivoices'):
+        mods = self.get_metadata(table, pid, 'mods')
+        if mods is None or len(mods) < 10:
             return {}
         return self.mt.extract_from_mods(mods)
 
     def get_restricted_pids(self, namespace):
-        pids = self.get_pids_from_objectstore(namespace)
         with open(f"{self.staging_dir}/restrictions.txt", "w") as f:
             f.write("pid, Role can view, User Can View, Role can manage, User can manage")
-            for pid in pids:
+            for pid in self.iter_pids(namespace):
                 foxml_file = self.dereference(pid)
                 foxml = f"{self.objectStore}/{foxml_file}"
                 try:
@@ -481,5 +971,6 @@ class ScholarUtilities:
                 print(f"{pid}")
 
 
-SU = ScholarUtilities()
-SU.get_restricted_pids('ivoices')
+if __name__ == '__main__':
+    SU = ScholarUtilities()
+    SU.get_restricted_pids('ivoices')
@@ -0,0 +1,198 @@
+import errno
+import fcntl
+import os
+import queue
+import shutil
+import threading
+import time
+
+from Journal import checksum
+
+# ioctl request to clone a file's extents (btrfs, XFS with reflink=1).
+FICLONE = 0x40049409
+# Errors meaning a strategy is unsupported for this pair of filesystems.
+UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EMLINK}
+# Strategies auto mode tries, cheapest first. hardlink is only used when asked for explicitly: a hardlinked
+# file is another name for the Fedora master, so anything rewriting it in place corrupts the datastreamStore.
+AUTO_STRATEGIES = ('reflink', 'copy_file_range', 'copy')
+
+
+class StagingEngine:
+    def __init__(self, concurrency=8, queue_size=1000, strategy='auto'):
+        self.concurrency = concurrency
+        self.strategy = strategy
+        self.strategies = {
+            'reflink': self.reflink,
+            'hardlink': self.hardlink,
+            'copy_file_range': self.copy_file_range,
+            'copy': self.plain_copy,
+        }
+        if strategy != 'auto' and strategy not in self.strategies:
+            raise ValueError(f"Unknown staging strategy {strategy!r}, expected auto or one of {', '.join(self.strategies)}")
+        # Strategy that worked for each (source device, destination device) pair.
+        self.detected = {}
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.completed = queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.files = 0
+        self.bytes = 0
+        self.failures = []
+        self.start_time = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish()
+
+    # Starts the pool of copier threads.
+    def start(self):
+        self.start_time = time.perf_counter()
+        for _ in range(self.concurrency):
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Queues a copy job, blocking while the queue is full.
+    def copy(self, pid, source, destination):
+        self.stage(pid, [(source, destination)])
+
+    # Queues all (source, destination) copies for one object as a single job.
+    def stage(self, pid, files):
+        self.jobs.put((pid, files))
+
+    # Returns (pid, status, checksum) for every job finished since the last call.
+    def drain(self):
+        finished = []
+        while True:
+            try:
+                finished.append(self.completed.get_nowait())
+            except queue.Empty:
+                return finished
+
+    # Records a failure that happened before a copy could be queued.
+    def fail(self, pid, reason):
+        with self.lock:
+            self.failures.append((pid, reason))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            pid, files = job
+            status = 'failed'
+            staged = []
+            # Every job is reported and marked done, whatever goes wrong, so the producer never waits forever.
+            try:
+                status = 'done'
+                for source, destination in files:
+                    try:
+                        self.transfer(source, destination)
+                        size = os.path.getsize(destination)
+                        staged.append(f"{os.path.basename(destination)}:{size}")
+                        with self.lock:
+                            self.files += 1
+                            self.bytes += size
+                    except Exception as e:
+                        status = 'failed'
+                        self.fail(pid, f"{source}: {type(e).__name__}: {e}")
+            finally:
+                self.completed.put((pid, status, checksum(*sorted(staged))))
+                self.jobs.task_done()
+
+    # Stages a file with the configured strategy, or the cheapest one the filesystems support.
+    def transfer(self, source, destination):
+        if self.strategy != 'auto':
+            return self.strategies[self.strategy](source, destination)
+        devices = (os.stat(source).st_dev, os.stat(os.path.dirname(destination) or '.').st_dev)
+        known = self.detected.get(devices)
+        if known:
+            return self.strategies[known](source, destination)
+        for name in AUTO_STRATEGIES:
+            strategy = self.strategies[name]
+            try:
+                strategy(source, destination)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+                continue
+            with self.lock:
+                self.detected.setdefault(devices, name)
+            return
+
+    def reflink(self, source, destination):
+        self.remove_existing(destination)
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                dst.close()
+                os.remove(destination)
+                raise
+        shutil.copymode(source, destination)
+
+    def hardlink(self, source, destination):
+        self.remove_existing(destination)
+        os.link(source, destination)
+
+    # Kernel-side copy; falls back to sendfile where copy_file_range is unavailable or cannot cross
+    # filesystems (EXDEV), then to a userspace copy.
+    def copy_file_range(self, source, destination):
+        # Never write through a hardlink left by an earlier run; that would overwrite the master.
+        self.remove_existing(destination)
+        use_range = hasattr(os, 'copy_file_range')
+        use_sendfile = True
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            remaining = os.fstat(src.fileno()).st_size
+            while remaining > 0:
+                try:
+                    if use_range:
+                        sent = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    elif use_sendfile:
+                        sent = os.sendfile(dst.fileno(), src.fileno(), None, remaining)
+                    else:
+                        shutil.copyfileobj(src, dst)
+                        break
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED:
+                        raise
+                    if use_range:
+                        use_range = False
+                    else:
+                        use_sendfile = False
+                    continue
+                if sent == 0:
+                    break
+                remaining -= sent
+        shutil.copymode(source, destination)
+
+    def plain_copy(self, source, destination):
+        self.remove_existing(destination)
+        shutil.copy(source, destination)
+
+    def remove_existing(self, destination):
+        if os.path.lexists(destination):
+            os.remove(destination)
+
+    # Waits for queued copies to drain, stops the copiers and prints a summary.
+    def finish(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.summary()
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        print(f"Staged {self.files} files ({self.bytes / 1048576:.1f} MiB) in {elapsed:.1f}s")
+        for devices, name in self.detected.items():
+            print(f"  device {devices[0]} -> {devices[1]}: {name}")
+        if self.failures:
+            print(f"{len(self.failures)} failures:")
+            for pid, reason in self.failures:
+                print(f"  {pid}: {reason}")
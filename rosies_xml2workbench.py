@@ -7,6 +7,9 @@ import os
 from glob import glob
 import random
 import re
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import edtf_validate.valid_edtf
 from edtf import text_to_edtf
 
@@ -22,227 +25,319 @@ def process_files(filenames,
                   fieldname_rewrites = {},
                   created_dates_map = {},
                   departments_map = {},
-                  scholars_map = {}):
-    files_processed = 0
-    files_written = 0
+                  scholars_map = {},
+                  jobs = 1):
+    options = prepare_options(fieldnames, formatted_text_fieldnames, single_valued_fieldnames, collections_map,
+                              id_column, link_fieldnames, edtf_fieldnames, fieldname_rewrites, created_dates_map,
+                              departments_map, scholars_map)
+    # FIXME Filter out a sample
+    #filenames = [filename for filename in filenames if random.random() <= 0.0625]
+    filenames = sorted(filenames)
+    if jobs > 1:
+        # Workers get the lookup maps once; map keeps the output in filename order.
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(options,)) as executor:
+            write_rows(output_filename, fieldnames, executor.map(clean_file, filenames, chunksize=32))
+    else:
+        init_worker(options)
+        write_rows(output_filename, fieldnames, map(clean_file, filenames))
+        print(validate_stripped_edtf_date.cache_info())
+
+
+# Same as process_files, for (name, <row> element) pairs built in memory rather than read from disk.
+def process_rows(rows,
+                 output_filename,
+                 fieldnames,
+                 formatted_text_fieldnames = [],
+                 single_valued_fieldnames = [],
+                 collections_map = {},
+                 id_column = 'field_pid',
+                 link_fieldnames = [],
+                 edtf_fieldnames = [],
+                 fieldname_rewrites = {},
+                 created_dates_map = {},
+                 departments_map = {},
+                 scholars_map = {}):
+    options = prepare_options(fieldnames, formatted_text_fieldnames, single_valued_fieldnames, collections_map,
+                              id_column, link_fieldnames, edtf_fieldnames, fieldname_rewrites, created_dates_map,
+                              departments_map, scholars_map)
+    write_rows(output_filename, fieldnames, (clean_row(row, name, **options) for name, row in rows))
+    print(validate_stripped_edtf_date.cache_info())
+
+
+def prepare_options(fieldnames,
+                    formatted_text_fieldnames,
+                    single_valued_fieldnames,
+                    collections_map,
+                    id_column,
+                    link_fieldnames,
+                    edtf_fieldnames,
+                    fieldname_rewrites,
+                    created_dates_map,
+                    departments_map,
+                    scholars_map):
     fieldnames.append('id')
     fieldnames.remove('field_model') # Fixme add this back in when we have a model.
+    return {'fieldnames': fieldnames,
+            'formatted_text_fieldnames': formatted_text_fieldnames,
+            'single_valued_fieldnames': single_valued_fieldnames,
+            'collections_map': collections_map,
+            'id_column': id_column,
+            'link_fieldnames': link_fieldnames,
+            'edtf_fieldnames': edtf_fieldnames,
+            'fieldname_rewrites': fieldname_rewrites,
+            'created_dates_map': created_dates_map,
+            'departments_map': departments_map,
+            'scholars_map': scholars_map}
+
+
+# Writes cleaned (data, invalid dates) results to the workbench CSV and prints the run report.
+def write_rows(output_filename, fieldnames, results):
+    files_processed = 0
+    files_written = 0
+    invalid_dates = defaultdict(Counter)
     with open(output_filename, 'w') as f:
         writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
         writer.writeheader()
-
-        for filename in filenames:
+        for data, invalid in results:
             files_processed += 1
-            # FIXME Filter out a sample
-            #if random.random() > 0.0625:
-            #    continue
-            tree = ET.parse(filename)
-            row = tree.getroot()
-
-            # Prepare data for workbench
-            data = {}
-            for leaf in row:
+            for field, values in invalid.items():
+                invalid_dates[field].update(values)
+            writer.writerow(data)
+            files_written += 1
 
-                if leaf.text is None or leaf.text.strip() == '' or leaf.text == 'T00:00:00Z':
+    print("Files processed: [{}]".format(files_processed))
+    print("Files written: [{}]".format(files_written))
+    for field, values in invalid_dates.items():
+        print("Field: [{}] invalid EDTF dates: [{}] ([{}] distinct)".format(field, sum(values.values()), len(values)))
+
+
+worker_options = {}
+
+
+def init_worker(options):
+    worker_options.update(options)
+
+
+def clean_file(filename):
+    tree = ET.parse(filename)
+    return clean_row(tree.getroot(), filename, **worker_options)
+
+
+# Cleans one <row> element into workbench values; returns the data and the invalid EDTF dates found.
+def clean_row(row,
+              filename,
+              fieldnames,
+              formatted_text_fieldnames = [],
+              single_valued_fieldnames = [],
+              collections_map = {},
+              id_column = 'field_pid',
+              link_fieldnames = [],
+              edtf_fieldnames = [],
+              fieldname_rewrites = {},
+              created_dates_map = {},
+              departments_map = {},
+              scholars_map = {}):
+    invalid_dates = defaultdict(Counter)
+
+    # Prepare data for workbench
+    data = {}
+    for leaf in row:
+
+        if leaf.text is None or leaf.text.strip() == '' or leaf.text == 'T00:00:00Z':
+            continue
+        if leaf.tag not in fieldnames:
+            if leaf.tag in fieldname_rewrites.keys():
+                leaf.tag = fieldname_rewrites[leaf.tag]
+            else:
+                print("Field name not found in fieldnames: [{}]".format(leaf.tag,))
+                continue
+
+        if '|' in leaf.text:
+            solved = process_pipe_exceptions(leaf)
+            if not solved:
+                print("ERROR: Text value contains illegal pipe character: [{}]".format(leaf.text))
+
+        # Un-encode XML ampersands.
+        if '&amp;' in leaf.text:
+            leaf.text = leaf.text.replace('&amp;', '&')
+
+        if leaf.tag in data.keys():
+            data[leaf.tag].append(leaf.text)
+        else:
+            data[leaf.tag] = [leaf.text]
+
+        if leaf.tag == id_column:
+            data['id'] = [leaf.text]
+
+    # Combine formatted text-type field instances (abstract) into one field.
+    for field in formatted_text_fieldnames:
+        if field in data.keys():
+            combined_value = ''
+            for instance in data[field]:
+                if not(instance.startswith('<p>')):
+                    element = ET.Element('p')
+                    element.text = instance
+                    combined_value += ET.tostring(element, encoding='unicode')
+                else:
+                    combined_value += instance
+            combined_value = html.unescape(combined_value)
+            combined_value = html.unescape(combined_value)
+            data[field] = [combined_value]
+
+    # Validate single-valued fields
+    for field in single_valued_fieldnames:
+        if field in data.keys():
+            if len(data[field]) > 1:
+                print("ERROR: single valued field [{}] has multiple values.".format(field))
+
+    # Map collections to field_member_of.
+    if 'field_member_of' in data.keys():
+        collection_ids = []
+        for instance in data['field_member_of']:
+            if instance in collections_map.keys():
+                collection_ids.append(collections_map[instance])
+            else:
+                print("ERROR: Collection not found in collection map: [{}]".format(instance))
+        data['field_member_of'] = collection_ids
+
+    # Map created_dates from fedora.
+    date_created = created_dates_map[data['field_pid'][0]].replace('Z', '+00:00')
+    data['created'] = [date_created]
+
+    # Put in genres when missing.
+    if 'field_genre' not in data.keys() or data['field_genre'] == '':
+        data['field_genre'] = ['unknown']
+        # FIXME this is a hack, put an actual value here.
+
+    # put in csl genres where missing.
+    if 'field_csl_type' not in data.keys() or data['field_csl_type'] == '':
+        data['field_csl_type'] = ['document']
+        # FIXME this is also a hack; put an actual value here.
+
+    # Fix Masters to Master.
+    if 'field_etd_degree_level' in data.keys():
+        if data['field_etd_degree_level'] == ['Masters']:
+            data['field_etd_degree_level'] = ['Master']
+
+    if 'field_note' in data.keys():
+        new_notes = []
+        for value in data['field_note']:
+            if value.startswith("Source type"):
+                continue
+            if value == ':':
+                continue
+            if value == 'Statement of responsibility:':
+                continue
+            else:
+                new_notes.append(value)
+        data['field_note'] = new_notes
+
+    # Deal with link fields that need http things.
+    for field in link_fieldnames:
+        links = []
+        if field in data.keys():
+            for instance in data[field]:
+                if instance.startswith('http'):
+                    links.append(instance)
+                else:
+                    new_value = process_link_exception(instance, data)
+                    if new_value is not None:
+                        links.append(new_value)
+            data[field] = links
+
+    # Validate EDTF values.
+    for field in edtf_fieldnames:
+        dates = set()
+        if field in data.keys():
+            for instance in data[field]:
+                # Ignore blanks.
+                if instance == 'T00:00:00Z':
                     continue
-                if leaf.tag not in fieldnames:
-                    if leaf.tag in fieldname_rewrites.keys():
-                        leaf.tag = fieldname_rewrites[leaf.tag]
-                    else:
-                        print("Field name not found in fieldnames: [{}]".format(leaf.tag,))
-                        continue
-
-                if '|' in leaf.text:
-                    solved = process_pipe_exceptions(leaf)
-                    if not solved:
-                        print("ERROR: Text value contains illegal pipe character: [{}]".format(leaf.text))
 
-                # Un-encode XML ampersands.
-                if '&amp;' in leaf.text:
-                    leaf.text = leaf.text.replace('&amp;', '&')
+                # validate EDTF
+                ok = validate_edtf_date(instance)
+                if ok:
+                    dates.add(instance)
+                    continue
 
-                if leaf.tag in data.keys():
-                    data[leaf.tag].append(leaf.text)
-                else:
-                    data[leaf.tag] = [leaf.text]
-
-                if leaf.tag == id_column:
-                    data['id'] = [leaf.text]
-
-            # Combine formatted text-type field instances (abstract) into one field.
-            for field in formatted_text_fieldnames:
-                if field in data.keys():
-                    combined_value = ''
-                    for instance in data[field]:
-                        if not(instance.startswith('<p>')):
-                            element = ET.Element('p')
-                            element.text = instance
-                            combined_value += ET.tostring(element, encoding='unicode')
-                        else:
-                            combined_value += instance
-                    combined_value = html.unescape(combined_value)
-                    combined_value = html.unescape(combined_value)
-                    data[field] = [combined_value]
-
-            # Validate single-valued fields
-            for field in single_valued_fieldnames:
-                if field in data.keys():
-                    if len(data[field]) > 1:
-                        print("ERROR: single valued field [{}] has multiple values.".format(field))
-
-            # Map collections to field_member_of.
-            if 'field_member_of' in data.keys():
-                collection_ids = []
-                for instance in data['field_member_of']:
-                    if instance in collections_map.keys():
-                        collection_ids.append(collections_map[instance])
-                    else:
-                        print("ERROR: Collection not found in collection map: [{}]".format(instance))
-                data['field_member_of'] = collection_ids
-
-            # Map created_dates from fedora.
-            date_created = created_dates_map[data['field_pid'][0]].replace('Z', '+00:00')
-            data['created'] = [date_created]
-
-            # Put in genres when missing.
-            if 'field_genre' not in data.keys() or data['field_genre'] == '':
-                data['field_genre'] = ['unknown']
-                # FIXME this is a hack, put an actual value here.
-
-            # put in csl genres where missing.
-            if 'field_csl_type' not in data.keys() or data['field_csl_type'] == '':
-                data['field_csl_type'] = ['document']
-                # FIXME this is also a hack; put an actual value here.
-
-            # Fix Masters to Master.
-            if 'field_etd_degree_level' in data.keys():
-                if data['field_etd_degree_level'] == ['Masters']:
-                    data['field_etd_degree_level'] = ['Master']
-
-            if 'field_note' in data.keys():
-                new_notes = []
-                for value in data['field_note']:
-                    if value.startswith("Source type"):
-                        continue
-                    if value == ':':
-                        continue
-                    if value == 'Statement of responsibility:':
-                        continue
-                    else:
-                        new_notes.append(value)
-                data['field_note'] = new_notes
-
-            # Deal with link fields that need http things.
-            for field in link_fieldnames:
-                links = []
-                if field in data.keys():
-                    for instance in data[field]:
-                        if instance.startswith('http'):
-                            links.append(instance)
-                        else:
-                            new_value = process_link_exception(instance, data)
-                            if new_value is not None:
-                                links.append(new_value)
-                    data[field] = links
-
-            # Validate EDTF values.
-            for field in edtf_fieldnames:
-                dates = set()
-                if field in data.keys():
-                    for instance in data[field]:
-                        # Ignore blanks.
-                        if instance == 'T00:00:00Z':
-                            continue
-
-                        # validate EDTF
-                        ok = validate_edtf_date(instance)
-                        if ok:
-                            dates.add(instance)
-                            continue
-
-                        # process exceptional values manually.
-                        sub = process_date_exceptions(data[id_column][0], field, instance)
-                        if sub is not None:
-                            dates.add(sub)
-                            continue
-
-                        # Parse dates to EDTF using text_to_edtf
-                        # (a bit iffy, which is why we take care of exceptions above.)
-                        parsed = text_to_edtf(instance)
-                        if parsed is None:
-
-                            # Dates that fail parsing
-                            if instance == '2021-04-31':
-                                instance = '2021-04-30'
-                                dates.add(instance)
-                            elif instance == '2022-11-31':
-                                instance = '2022-11-30'
-                                dates.add(instance)
-                            else:
-                                print("Field: [{}] BAD DATE: [{}] in file [{}]".format(field, instance, filename))
-                        else:
-                            # These are all good dates, Brent.
-                            if field not in ['field_date_issued', 'field_date_submitted', 'field_host_date_issued',
-                                             'field_host_date_copyrighted']:
-                                print('Field: [{}] good date: [{}] from [{}] in file [{}]'.format(field, parsed, instance, filename))
-                            dates.add(parsed)
-
-                    data[field] = list(dates)
-
-            # Dedupe other fields not in EDTF:
-            if field in ['field_part_date']:
-                if len(data[field]) > 1:
-                    data[field] = list(set(data[field]))
-
-            # Map departments to term_ids
-            if 'field_department' in data.keys():
-                values = []
-                for value in data['field_department']:
-                    key = value.strip().replace('<br/>','').lower()
-
-                    if key not in departments_map.keys():
-                        print("Department not in lookup: [{}]".format(key))
-                        continue
-                    else:
-                        values.append(departments_map[key])
-                data['field_department'] = values
-
-            # Map scholars to their IDs.
-            if 'field_scholar' in data.keys():
-                values = []
-                for value in data['field_scholar']:
-                    key = value.strip().replace('<br/>','').replace('@upei.ca','').lower()
-
-                    # Corrections - this should be done in preprocess!
-                    if key in ['correction--2005']:
-                        continue
-                    elif key == 'wmwhelan':
-                        key='wwhelan'
-                    elif key == 'pl':
-                        key='plmckenna'
-
-                    elif key == '9606':
-                        continue
-
-                    if key not in scholars_map.keys():
-                        print("Scholar not in lookup: [{}]".format(key))
-                        values.append(key)
+                # process exceptional values manually.
+                sub = process_date_exceptions(data[id_column][0], field, instance)
+                if sub is not None:
+                    dates.add(sub)
+                    continue
 
+                # Parse dates to EDTF using text_to_edtf
+                # (a bit iffy, which is why we take care of exceptions above.)
+                parsed = text_to_edtf(instance)
+                if parsed is None:
+
+                    # Dates that fail parsing
+                    if instance == '2021-04-31':
+                        instance = '2021-04-30'
+                        dates.add(instance)
+                    elif instance == '2022-11-31':
+                        instance = '2022-11-30'
+                        dates.add(instance)
                     else:
-                        values.append(scholars_map[key])
-                data['field_scholar'] = values
-
-            # Merge with pipe characters
-            for field, values in data.items():
-                data[field] = '|'.join(values)
-
-            # Write to output.
-            #print(data)
-            writer.writerow(data)
-            files_written += 1
-
-    print("Files processed: [{}]".format(files_processed))
-    print("Files written: [{}]".format(files_written))
+                        print("Field: [{}] BAD DATE: [{}] in file [{}]".format(field, instance, filename))
+                        invalid_dates[field][instance] += 1
+                else:
+                    # These are all good dates, Brent.
+                    if field not in ['field_date_issued', 'field_date_submitted', 'field_host_date_issued',
+                                     'field_host_date_copyrighted']:
+                        print('Field: [{}] good date: [{}] from [{}] in file [{}]'.format(field, parsed, instance, filename))
+                    dates.add(parsed)
+
+            data[field] = list(dates)
+
+    # Dedupe other fields not in EDTF:
+    if field in ['field_part_date']:
+        if len(data[field]) > 1:
+            data[field] = list(set(data[field]))
+
+    # Map departments to term_ids
+    if 'field_department' in data.keys():
+        values = []
+        for value in data['field_department']:
+            key = value.strip().replace('<br/>','').lower()
+
+            if key not in departments_map.keys():
+                print("Department not in lookup: [{}]".format(key))
+                continue
+            else:
+                values.append(departments_map[key])
+        data['field_department'] = values
+
+    # Map scholars to their IDs.
+    if 'field_scholar' in data.keys():
+        values = []
+        for value in data['field_scholar']:
+            key = value.strip().replace('<br/>','').replace('@upei.ca','').lower()
+
+            # Corrections - this should be done in preprocess!
+            if key in ['correction--2005']:
+                continue
+            elif key == 'wmwhelan':
+                key='wwhelan'
+            elif key == 'pl':
+                key='plmckenna'
+
+            elif key == '9606':
+                continue
+
+            if key not in scholars_map.keys():
+                print("Scholar not in lookup: [{}]".format(key))
+                values.append(key)
+
+            else:
+                values.append(scholars_map[key])
+        data['field_scholar'] = values
+
+    # Merge with pipe characters
+    for field, values in data.items():
+        data[field] = '|'.join(values)
+
+    return data, invalid_dates
 
 
 def process_pipe_exceptions(leaf):
@@ -303,58 +398,42 @@ def process_link_exception(value, data):
     print('pid: [{}], value: [{}]'.format(data['id'], value))
     return None
 
+# EDTF qualified dates with unspecified digits (nnnX?, nnXX~, nXXX%, XXXX?, ...) that edtf_validate rejects.
+QUALIFIED_UNSPECIFIED = re.compile(r"^(?:[1-2](?:\d\dX|\dXX|XXX)|XXXX)[?~%]")
+
+
 def validate_edtf_date(date):
-    date = date.strip()
-    # nnnX?
-    if re.match(r"^[1-2]\d\dX\?", date):
-        return True
-    # nnXX?
-    elif re.match(r"^[1-2]\dXX\?", date):
-        return True
-    # nXXX?
-    elif re.match(r"^[1-2]XXX\?", date):
-        return True
-    # nXXX~
-    elif re.match(r"^[1-2]XXX\~", date):
-        return True
-    # nnXX~
-    elif re.match(r"^[1-2]\dXX\~", date):
-        return True
-    # nnnX~
-    elif re.match(r"^[1-2]\d\dX\~", date):
-        return True
-    # nXXX%
-    elif re.match(r"^[1-2]XXX\%", date):
-        return True
-    # nnXX%
-    elif re.match(r"^[1-2]\dXX\%", date):
-        return True
-    # nnnX%
-    elif re.match(r"^[1-2]\d\dX\%", date):
-        return True
-    # XXXX?
-    elif re.match(r"^XXXX\?", date):
-        return True
-    # XXXX~
-    elif re.match(r"^XXXX\~", date):
-        return True
-    # XXXX%
-    elif re.match(r"^XXXX\%", date):
-        return True
-    elif edtf_validate.valid_edtf.is_valid(date):
+    return validate_stripped_edtf_date(date.strip())
+
+
+@lru_cache(maxsize=65536)
+def validate_stripped_edtf_date(date):
+    if QUALIFIED_UNSPECIFIED.match(date):
         return True
-    else:
-        return False
+    return edtf_validate.valid_edtf.is_valid(date)
 
 def main():
-    directory_name = sys.argv[1]
+    # Usage: rosies_xml2workbench.py <directory> <output.csv> [--jobs N]
+    args = sys.argv[1:]
+    jobs = 1
+    if '--jobs' in args:
+        index = args.index('--jobs')
+        jobs = int(args[index + 1])
+        del args[index:index + 2]
+    directory_name = args[0]
     filenames = glob(os.path.join(directory_name, '*.xml'))
     if len(filenames) == 0:
         print("no files found.")
         exit()
 
-    output_filename = sys.argv[2]
+    output_filename = args[1]
+
+    # Prepare output file
+    process_files(filenames, output_filename, jobs=jobs, **load_options())
+
 
+# Loads fieldnames and lookup maps; returns them as keyword arguments for process_files / process_rows.
+def load_options():
     # Import fieldnames from file, store in list.
     fieldnames = []
     dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -402,10 +481,18 @@ def main():
         for row in reader:
             if row['u1'] is not None:
                 scholars_map[row['u1'].lower()] = row['term_id']
-    # Prepare output file
-    process_files(filenames, output_filename, fieldnames, formatted_text_fieldnames, single_valued_fieldnames,
-                  collections_map, 'field_pid', link_fieldnames, edtf_fieldnames, fieldname_rewrites,
-                  created_dates_map, departments_map, scholars_map)
+
+    return {'fieldnames': fieldnames,
+            'formatted_text_fieldnames': formatted_text_fieldnames,
+            'single_valued_fieldnames': single_valued_fieldnames,
+            'collections_map': collections_map,
+            'id_column': 'field_pid',
+            'link_fieldnames': link_fieldnames,
+            'edtf_fieldnames': edtf_fieldnames,
+            'fieldname_rewrites': fieldname_rewrites,
+            'created_dates_map': created_dates_map,
+            'departments_map': departments_map,
+            'scholars_map': scholars_map}
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
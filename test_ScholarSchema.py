@@ -0,0 +1,11 @@
+import sqlite3
+
+import ScholarSchema
+
+
+def test_hot_queries_use_indexes():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE islandscholar(pid TEXT PRIMARY KEY, content_model TEXT, collection_pid TEXT)")
+    ScholarSchema.upgrade(conn)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == ScholarSchema.SCHEMA_VERSION
+    assert ScholarSchema.check_query_plans(conn, 'islandscholar') == []